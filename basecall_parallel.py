@@ -0,0 +1,442 @@
+"""
+basecalls a batch of reads on a pool of worker processes. The posteriors
+are copied once in to shared memory, which every worker reads from, rather
+than being pickled and sent to each worker. Each worker runs find_path and
+stitch_kmers on the reads it is given, and the sequences are returned in
+the same order as the reads.
+A single long read can also be decoded in overlapping windows on a pool of
+threads or processes, see decode_windows.
+"""
+import time
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from utils import ImpossibleTransitionError, PosteriorProvider
+from utils import as_posterior_array
+import viterbi_basecall_tools_stays as stays
+
+# set in each worker by _attach_posteriors
+_worker = {}
+
+
+def basecall_reads(posteriors, workers=None, chunk_size=1, engine="numpy",
+                   log_space=False, compact=False):
+    """
+    basecalls every read in a batch of posteriors on a pool of processes.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events), as returned by get_posteriors
+    :param workers: number of worker processes, by default one per cpu
+    :param chunk_size: number of reads handed to a worker at a time
+    :param engine: decoder used by find_path
+    :param log_space: passed to find_path
+    :param compact: passed to find_path
+    :type posteriors: numpy array / torch tensor
+    :type workers: int
+    :type chunk_size: int
+    :type engine: string
+    :type log_space: bool
+    :type compact: bool
+    returns a list with the sequence of each read, in the same order as the
+    reads. Reads with an impossible transition in their posteriors are
+    given None.
+    """
+    settings = {"engine": engine, "log_space": log_space, "compact": compact}
+    with _pool(workers) as pool:
+        shared, result = _start_batch(pool, posteriors, chunk_size, settings)
+        return _finish_batch(shared, result)
+
+
+def basecall_pipelined(data, model_class_path, model_path, batch_size=8,
+                       workers=None, chunk_size=1, engine="numpy",
+                       log_space=False, compact=False):
+    """
+    puts data through the model in mini batches on one thread while the
+    worker processes basecall the batches already inferred, so that the
+    network and the decoding run at the same time.
+    :param data: data to be inputted in to model in form NHC
+    :param model_class_path: path to model class
+    :param model_path: path pickle of train model
+    :param batch_size: number of reads put through the model at a time
+    :param workers: number of worker processes, by default one per cpu
+    :param chunk_size: number of reads handed to a worker at a time
+    :param engine: decoder used by find_path
+    :param log_space: passed to find_path
+    :param compact: passed to find_path
+    :type data: numpy array
+    :type model_class_path: string
+    :type model_path: string
+    :type batch_size: int
+    :type workers: int
+    :type chunk_size: int
+    :type engine: string
+    :type log_space: bool
+    :type compact: bool
+    returns a list with the sequence of each read, as basecall_reads.
+    """
+    settings = {"engine": engine, "log_space": log_space, "compact": compact}
+    provider = PosteriorProvider(
+        model_class_path, model_path, batch_size=batch_size)
+    sequences = []
+    pending = []
+    # the pool is started before the inference thread, so that no worker
+    # is forked while the model is running
+    with _pool(workers) as pool:
+        for posteriors in provider.iter_posteriors(data):
+            pending.append(
+                _start_batch(pool, posteriors, chunk_size, settings))
+            # free the batches which have already been basecalled
+            while pending and pending[0][1].ready():
+                sequences.extend(_finish_batch(*pending.pop(0)))
+        for shared, result in pending:
+            sequences.extend(_finish_batch(shared, result))
+    return sequences
+
+
+def _pool(workers):
+    """
+    starts the worker processes.
+    """
+    # workers must share the resource tracker of this process, otherwise
+    # each one starts its own and warns that the shared memory this process
+    # unlinks has leaked
+    resource_tracker.ensure_running()
+    # build the transition structure before forking, so the workers start
+    # with it rather than each building their own
+    stays.predecessor_arrays(stays.transition, k=5)
+    return multiprocessing.Pool(workers)
+
+
+def _thread_pool(workers):
+    """
+    starts the worker threads.
+    """
+    # build the transition structure first, so the threads do not each
+    # build it at once
+    stays.predecessor_arrays(stays.transition, k=5)
+    return ThreadPool(workers)
+
+
+def _start_batch(pool, posteriors, chunk_size, settings):
+    """
+    copies a batch of posteriors in to shared memory and hands its reads
+    to the pool. returns the shared memory and the pending result.
+    """
+    posteriors = as_posterior_array(posteriors)
+    shared = _share(posteriors)
+    try:
+        tasks = [
+            (shared.name, posteriors.shape, posteriors.dtype.str, index,
+             settings)
+            for index in range(len(posteriors))]
+        result = pool.map_async(_basecall_read, tasks, chunksize=chunk_size)
+    except BaseException:
+        shared.close()
+        shared.unlink()
+        raise
+    return shared, result
+
+
+def _share(posteriors):
+    """
+    copies posteriors in to a new block of shared memory.
+    """
+    shared = shared_memory.SharedMemory(create=True, size=posteriors.nbytes)
+    try:
+        shared_posteriors = np.ndarray(
+            posteriors.shape, dtype=posteriors.dtype, buffer=shared.buf)
+        shared_posteriors[:] = posteriors
+        del shared_posteriors
+    except BaseException:
+        shared.close()
+        shared.unlink()
+        raise
+    return shared
+
+
+def _finish_batch(shared, result):
+    """
+    waits for a batch to be basecalled and frees its shared memory.
+    """
+    try:
+        return result.get()
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _attach_posteriors(name, shape, dtype):
+    """
+    gives a worker a view of the shared posteriors of a batch, closing
+    those of the previous batch.
+    """
+    if _worker.get("name") != name:
+        if "shared" in _worker:
+            del _worker["posteriors"]
+            _worker["shared"].close()
+        shared = shared_memory.SharedMemory(name=name)
+        _worker["name"] = name
+        _worker["shared"] = shared
+        _worker["posteriors"] = np.ndarray(
+            shape, dtype=dtype, buffer=shared.buf)
+    return _worker["posteriors"]
+
+
+def _basecall_read(task):
+    """
+    basecalls one read from the shared posteriors.
+    """
+    # imported here as run_viterbi imports this module
+    from run_viterbi import find_path
+    name, shape, dtype, index, settings = task
+    posterior = _attach_posteriors(name, shape, dtype)[index]
+    try:
+        path, transitions = find_path(
+            posterior, None, verbose=False, **settings)
+    except ImpossibleTransitionError as error:
+        print("read", index, ":", error)
+        return None
+    return stays.stitch_kmers(path, transitions)
+
+
+def windows(events, window, overlap):
+    """
+    the start and end event of each window a read is split in to. Each
+    window overlaps the one before by overlap events, and the last ends at
+    the end of the read.
+    :param events: number of events in the read
+    :param window: number of events in each window
+    :param overlap: number of events each window shares with the next, at
+    least 1 so that neighbouring windows can be joined
+    :type events: int
+    :type window: int
+    :type overlap: int
+    returns a list of (start, end) pairs
+    """
+    if not 0 < overlap < window:
+        raise ValueError("overlap must be at least 1 and less than window")
+    step = window - overlap
+    return [(start, min(start + window, events))
+            for start in range(0, max(events - overlap, 1), step)]
+
+
+def decode_windows(posterior, window=2000, overlap=200, workers=None,
+                   processes=False, pool=None, engine="numpy",
+                   log_space=False, compact=False):
+    """
+    decodes one read in overlapping windows at the same time, then joins
+    the paths of neighbouring windows at an event in their overlap where
+    they are in the same kmer, taking the one nearest the middle of the
+    overlap as the ends of a window are the least reliable. If no event of
+    an overlap agrees, the two windows are decoded again as one.
+    The path can differ from decoding the whole read at once, see
+    window_report.
+    :param posterior: posterior probabilities in the form (states, events)
+    :param window: number of events in each window
+    :param overlap: number of events each window shares with the next
+    :param workers: number of threads or processes, by default one per cpu
+    :param processes: whether to decode on processes rather than threads.
+    The numpy and numba engines spend most of their time outside the
+    interpreter lock, so threads avoid copying the posteriors for them.
+    :param pool: pool to decode on, rather than starting one
+    :param engine: decoder used by find_path
+    :param log_space: passed to find_path
+    :param compact: passed to find_path
+    :type posterior: numpy array / torch tensor
+    :type window: int
+    :type overlap: int
+    :type workers: int
+    :type processes: bool
+    :type pool: multiprocessing Pool / ThreadPool
+    :type engine: string
+    :type log_space: bool
+    :type compact: bool
+    returns the path and transitions, as determine_path, and the number of
+    overlaps which had to be decoded again. Raises
+    ImpossibleTransitionError if a window has an impossible transition.
+    """
+    posterior = as_posterior_array(posterior)
+    settings = {"engine": engine, "log_space": log_space, "compact": compact}
+    spans = windows(posterior.shape[1], window, overlap)
+    if pool is not None:
+        decoded = _decode_spans(pool, posterior, spans, settings)
+    elif processes:
+        with _pool(workers) as pool:
+            decoded = _decode_spans(pool, posterior, spans, settings)
+    else:
+        with _thread_pool(workers) as pool:
+            decoded = _decode_spans(pool, posterior, spans, settings)
+    # each kept window is (start, path, transitions, cut), where cut is
+    # the event from which its path is used
+    kept = []
+    redecoded = 0
+    for (start, end), (path, transitions) in zip(spans, decoded):
+        while kept:
+            cut = _join_event(kept[-1], start, path)
+            if cut is not None:
+                break
+            # decode the last window kept and this one as one window, and
+            # join that to the window before instead
+            redecoded += 1
+            start = kept.pop()[0]
+            path, transitions = _check_window(
+                _find_window(posterior, start, end, settings))
+        else:
+            cut = 0
+        kept.append((start, path, transitions, cut))
+    # the path of each window is used from its cut to the next window's
+    joined_path = []
+    joined_transitions = []
+    cuts = [cut for start, path, transitions, cut in kept[1:]] + [None]
+    for (start, path, transitions, cut), next_cut in zip(kept, cuts):
+        last = None if next_cut is None else next_cut - start
+        joined_path.extend(path[cut - start:last])
+        joined_transitions.extend(transitions[cut - start:last])
+    return joined_path, joined_transitions, redecoded
+
+
+def _decode_spans(pool, posterior, spans, settings):
+    """
+    decodes each window of a read on a pool. returns a list with the path
+    and transitions of each window.
+    """
+    if isinstance(pool, ThreadPool):
+        results = pool.starmap(
+            _find_window,
+            [(posterior, start, end, settings) for start, end in spans])
+    else:
+        shared = _share(posterior)
+        try:
+            results = pool.map(_decode_window, [
+                (shared.name, posterior.shape, posterior.dtype.str, start,
+                 end, settings)
+                for start, end in spans])
+        finally:
+            shared.close()
+            shared.unlink()
+    return [_check_window(result) for result in results]
+
+
+def _check_window(result):
+    """
+    raises ImpossibleTransitionError for a window with an impossible
+    transition, otherwise returns its path and transitions.
+    """
+    path, transitions, impossible_event = result
+    if impossible_event is not None:
+        raise ImpossibleTransitionError(impossible_event)
+    return path, transitions
+
+
+def _find_window(posterior, start, end, settings):
+    """
+    decodes the events start to end of a read. returns the path and
+    transitions, and the event of the read with an impossible transition
+    if there is one. The error is not raised here so that it does not have
+    to be sent back from a worker process.
+    """
+    # imported here as run_viterbi imports this module
+    from run_viterbi import find_path
+    try:
+        path, transitions = find_path(
+            posterior[:, start:end], None, verbose=False, **settings)
+    except ImpossibleTransitionError as error:
+        return None, None, error.event + start
+    return path, transitions, None
+
+
+def _decode_window(task):
+    """
+    decodes a window of the shared posteriors of a read.
+    """
+    name, shape, dtype, start, end, settings = task
+    posterior = _attach_posteriors(name, shape, dtype)
+    return _find_window(posterior, start, end, settings)
+
+
+def _join_event(previous, start, path):
+    """
+    the event nearest the middle of the overlap of two windows at which
+    their paths are in the same kmer, or None if there is none.
+    :param previous: the earlier window, as kept by decode_windows
+    :param start: first event of the later window
+    :param path: path of the later window
+    """
+    previous_start, previous_path, previous_transitions, previous_cut = \
+        previous
+    end = previous_start + len(previous_path)
+    # the earlier window's path is only used from its cut
+    first = max(start, previous_cut)
+    if first >= end:
+        return None
+    agree = np.flatnonzero(
+        np.array(previous_path[first - previous_start:]) ==
+        np.array(path[first - start:end - start])) + first
+    if len(agree) == 0:
+        return None
+    middle = (start + end) // 2
+    return int(agree[np.argmin(np.abs(agree - middle))])
+
+
+def window_report(posteriors, settings=((500, 50), (1000, 100)),
+                  workers=None, processes=False, engine="numpy",
+                  log_space=False, compact=False):
+    """
+    compares decoding each read of a batch in overlapping windows with
+    decoding the whole read at once.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events)
+    :param settings: (window, overlap) of each setting to try
+    :param workers: number of threads or processes, by default one per cpu
+    :param processes: whether to decode on processes rather than threads
+    :param engine: decoder used by find_path
+    :param log_space: passed to find_path
+    :param compact: passed to find_path
+    :type posteriors: numpy array / torch tensor
+    :type settings: tuple
+    :type workers: int
+    :type processes: bool
+    :type engine: string
+    :type log_space: bool
+    :type compact: bool
+    returns a list with a dictionary for each setting, holding the time
+    taken, the fractions from viterbi_basecall_tools_stays.compare_paths
+    and the number of overlaps decoded again, along with a dictionary for
+    decoding whole reads.
+    """
+    from run_viterbi import find_path
+    posteriors = as_posterior_array(posteriors)
+    find_settings = {
+        "engine": engine, "log_space": log_space, "compact": compact}
+    start_time = time.time()
+    exact = []
+    for posterior in posteriors:
+        try:
+            exact.append(find_path(
+                posterior, None, verbose=False, **find_settings))
+        except ImpossibleTransitionError:
+            exact.append(None)
+    report = [{"setting": "whole read", "seconds": time.time() - start_time,
+               **stays.compare_paths(exact, exact), "redecoded": 0}]
+    pool = _pool(workers) if processes else _thread_pool(workers)
+    with pool:
+        for window, overlap in settings:
+            start_time = time.time()
+            results = []
+            redecoded = 0
+            for posterior in posteriors:
+                try:
+                    path, transitions, windows_redecoded = decode_windows(
+                        posterior, window=window, overlap=overlap,
+                        pool=pool, **find_settings)
+                except ImpossibleTransitionError:
+                    results.append(None)
+                    continue
+                results.append((path, transitions))
+                redecoded += windows_redecoded
+            seconds = time.time() - start_time
+            report.append({
+                "setting": "window={} overlap={}".format(window, overlap),
+                "seconds": seconds, **stays.compare_paths(results, exact),
+                "redecoded": redecoded})
+    return report
@@ -0,0 +1,324 @@
+"""
+benchmarks the decoders on synthetic posteriors, so that changes in speed
+and memory can be tracked between versions.
+Each read is a random walk through the kmers with stays and skips, so the
+true path is known. Its posteriors put most of the probability on the true
+state of each event and spread the rest as noise over a random subset of
+the other states, leaving the fraction given by sparsity at zero.
+The decode, determine_path and stitch_kmers stages are timed separately,
+and the results are written as JSON, e.g.
+
+    python benchmark.py -k 3 --events 200 1000 --sparsity 0.9 -o bench.json
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import viterbi_basecall_tools_basic as basic
+import viterbi_basecall_tools_stays as stays
+import numba_kernels
+
+
+def random_walk(events, k=5, stay_prob=0.2, skip_prob=0.05, rng=None):
+    """
+    a random path through the kmers, as determine_path would return it.
+    :param events: number of events
+    :param k: k for kmer
+    :param stay_prob: probability of each event after the first being a stay
+    :param skip_prob: probability of each event after the first being a skip
+    :param rng: random number generator
+    :type events: int
+    :type k: int
+    :type stay_prob: float
+    :type skip_prob: float
+    :type rng: numpy Generator
+    returns path of kmer numbers and transitions, as python lists
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    mask = 4**k - 1
+    moves = rng.choice(
+        [0, 1, 2], size=events - 1,
+        p=[stay_prob, skip_prob, 1 - stay_prob - skip_prob])
+    new_bases = rng.integers(0, 16, size=events - 1)
+    kmer = int(rng.integers(0, 4**k))
+    path = [kmer + 1]
+    transitions = []
+    for move, bases in zip(moves.tolist(), new_bases.tolist()):
+        if move == 2:
+            kmer = ((kmer << 2) & mask) | (bases & 3)
+        elif move == 1:
+            kmer = ((kmer << 4) & mask) | bases
+        # a skip which could also have been a step is a step to the
+        # decoders, and so is a step in to the same kmer
+        transitions.append(
+            0 if move == 0 else stays.transition(path[-1], kmer + 1, k=k))
+        path.append(kmer + 1)
+    return path, transitions
+
+
+def synthetic_posteriors(path, transitions, k=5, noise=0.1, sparsity=0.9,
+                         rng=None):
+    """
+    posteriors for a path from random_walk. Events which are stays put their
+    probability on the stay state, as the model does.
+    :param path: kmer numbers
+    :param transitions: transitions between the kmers
+    :param k: k for kmer
+    :param noise: probability spread over states other than the true one
+    :param sparsity: fraction of the other states left at zero
+    :param rng: random number generator
+    :type path: list
+    :type transitions: list
+    :type k: int
+    :type noise: float
+    :type sparsity: float
+    :type rng: numpy Generator
+    returns posterior probabilities in the form (states, events)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    states = 4**k + 1
+    events = len(path)
+    truth = np.array(path)
+    truth[1:][np.array(transitions, dtype=np.int64) == 0] = 0
+    posterior = rng.random((states, events))
+    posterior[rng.random((states, events)) < sparsity] = 0
+    posterior[truth, np.arange(events)] = 0
+    totals = posterior.sum(axis=0)
+    totals[totals == 0] = 1
+    posterior *= noise / totals
+    posterior[truth, np.arange(events)] = 1 - noise
+    return posterior
+
+
+def _decode_numpy(posterior, k):
+    return stays.viterbi_numpy(posterior, stays.transition, k=k)
+
+
+def _decode_numba(posterior, k):
+    return stays.viterbi_numba(posterior, stays.transition, k=k)
+
+
+def _decode_python(posterior, k):
+    return stays.viterbi(
+        posterior, stays.transition, k=k, log_space=True, compact=True)
+
+
+def _decode_sparse(posterior, k):
+    return stays.viterbi_sparse(
+        posterior, stays.transition, k=k, log_space=True, compact=True)
+
+
+def _decode_checkpoint(posterior, k):
+    return stays.viterbi_checkpointed(posterior, stays.transition, k=k)
+
+
+def _decode_basic(posterior, k):
+    return basic.viterbi(posterior, basic.transition, k=k, log_space=True)
+
+
+# for each engine, the decoder and the function tracing back its output
+engines = {
+    "basic": (_decode_basic, basic.determine_path),
+    "python": (_decode_python, stays.determine_path),
+    "sparse": (_decode_sparse, stays.determine_path),
+    "numpy": (_decode_numpy, stays.determine_path),
+    "numba": (_decode_numba, stays.determine_path),
+    "checkpoint": (_decode_checkpoint, stays.determine_path_checkpointed),
+}
+
+
+def _stages(engine, posterior, k):
+    """
+    runs each stage of an engine once. returns the time taken by each
+    stage, and the path and sequence found.
+    """
+    decode, trace_back = engines[engine]
+    seconds = {}
+    start_time = time.perf_counter()
+    tables = decode(posterior, k)
+    seconds["decode"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    found = trace_back(*tables)
+    seconds["determine_path"] = time.perf_counter() - start_time
+    if engine == "basic":
+        # the basic decoder has no transitions to stitch with
+        return seconds, found, None
+    path, transitions = found
+    start_time = time.perf_counter()
+    sequence = stays.stitch_kmers(path, transitions, k=k)
+    seconds["stitch_kmers"] = time.perf_counter() - start_time
+    return seconds, path, sequence
+
+
+def _peak_memory(engine, posterior, k):
+    """
+    peak memory allocated by each stage of an engine, in bytes, not
+    counting what earlier stages still hold, such as the decoded tables.
+    """
+    decode, trace_back = engines[engine]
+    peaks = {}
+
+    def measure(stage, function, *args, **kwargs):
+        tracemalloc.reset_peak()
+        held = tracemalloc.get_traced_memory()[0]
+        output = function(*args, **kwargs)
+        peaks[stage] = tracemalloc.get_traced_memory()[1] - held
+        return output
+
+    tracemalloc.start()
+    try:
+        tables = measure("decode", decode, posterior, k)
+        found = measure("determine_path", trace_back, *tables)
+        if engine != "basic":
+            measure("stitch_kmers", stays.stitch_kmers, *found, k=k)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def benchmark(engine, k, events, sparsity=0.9, noise=0.1, stay_prob=0.2,
+              skip_prob=0.05, repeat=3, memory=True, seed=0):
+    """
+    times an engine on one synthetic read.
+    :param engine: one of the keys of engines
+    :param k: k for kmer
+    :param events: number of events in the read
+    :param sparsity: see synthetic_posteriors
+    :param noise: see synthetic_posteriors
+    :param stay_prob: see random_walk
+    :param skip_prob: see random_walk
+    :param repeat: number of runs, the fastest time of each stage is kept
+    :param memory: whether to measure peak memory, in a separate run as
+    tracemalloc slows the stages down
+    :param seed: seed of the random number generator
+    :type engine: string
+    :type k: int
+    :type events: int
+    :type sparsity: float
+    :type noise: float
+    :type stay_prob: float
+    :type skip_prob: float
+    :type repeat: int
+    :type memory: bool
+    :type seed: int
+    returns a dictionary of the settings and results, which can be written
+    as JSON
+    """
+    if engine == "basic":
+        # the basic transition function does not allow skips
+        skip_prob = 0
+    rng = np.random.default_rng(seed)
+    path, transitions = random_walk(
+        events, k=k, stay_prob=stay_prob, skip_prob=skip_prob, rng=rng)
+    posterior = synthetic_posteriors(
+        path, transitions, k=k, noise=noise, sparsity=sparsity, rng=rng)
+    best = {}
+    for run in range(repeat):
+        seconds, found_path, sequence = _stages(engine, posterior, k)
+        for stage, taken in seconds.items():
+            best[stage] = min(taken, best.get(stage, taken))
+    result = {
+        "engine": engine, "k": k, "events": events, "sparsity": sparsity,
+        "noise": noise, "stay_prob": stay_prob, "skip_prob": skip_prob,
+        "seed": seed, "seconds": best,
+        "events_per_second": events / best["decode"],
+    }
+    if engine == "basic":
+        # the basic decoder treats the stay state as a kmer, so its path
+        # is not compared with the true one
+        result["path_accuracy"] = None
+        result["sequence_correct"] = None
+    else:
+        result["path_accuracy"] = float(
+            np.mean(np.array(found_path) == np.array(path)))
+        result["sequence_correct"] = (
+            sequence == stays.stitch_kmers(path, transitions, k=k))
+    if memory:
+        result["peak_bytes"] = _peak_memory(engine, posterior, k)
+    return result
+
+
+def _git_commit():
+    """
+    the commit being benchmarked, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--engines", type=str, nargs="+",
+                    choices=sorted(engines),
+                    default=["basic", "python", "sparse", "numpy",
+                             "numba", "checkpoint"],
+                    dest="engines",
+                    help='decoders to benchmark, numba is skipped when it '
+                    'is not installed')
+parser.add_argument("-k", type=int, nargs="+", default=[3], dest="k",
+                    help='k for kmer')
+parser.add_argument("--events", type=int, nargs="+", default=[200, 1000],
+                    dest="events", help='number of events in each read')
+parser.add_argument("--sparsity", type=float, nargs="+", default=[0.9],
+                    dest="sparsity",
+                    help='fraction of states other than the true one with '
+                    'zero posterior')
+parser.add_argument("--noise", type=float, default=0.1, dest="noise",
+                    help='posterior probability not on the true state')
+parser.add_argument("--repeat", type=int, default=3, dest="repeat",
+                    help='runs of each benchmark, the fastest is kept')
+parser.add_argument("--no-memory", action="store_false", dest="memory",
+                    help='do not measure peak memory')
+parser.add_argument("--seed", type=int, default=0, dest="seed",
+                    help='seed for the synthetic reads')
+parser.add_argument("-o", "--output", type=str, default=None,
+                    dest="output",
+                    help='file to write the JSON results to, by default '
+                    'they are printed')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if "numba" in args.engines and not numba_kernels.available:
+        # the numba engine would time the numpy fallback under its name
+        print("numba is not installed, skipping the numba engine",
+              file=sys.stderr)
+        args.engines = [
+            engine for engine in args.engines if engine != "numba"]
+    results = []
+    for k in args.k:
+        for events in args.events:
+            for sparsity in args.sparsity:
+                for engine in args.engines:
+                    result = benchmark(
+                        engine, k, events, sparsity=sparsity,
+                        noise=args.noise, repeat=args.repeat,
+                        memory=args.memory, seed=args.seed)
+                    print(
+                        "{engine} k={k} events={events} sparsity={sparsity}:"
+                        " {events_per_second:.0f} events/s".format(**result),
+                        file=sys.stderr)
+                    results.append(result)
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": (numba_kernels.numba.__version__
+                  if numba_kernels.available else None),
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,172 @@
+"""
+viterbi decoding of a generic hidden markov model, for models other than the
+basecaller, e.g. tagging the parts of a read by quality.
+The model is given with named states and observations, as in the wikipedia
+example, and is turned in to arrays of log probabilities indexed by state
+number, so that many observation sequences are decoded together, one event
+of every sequence at a time.
+
+    model = HMM(states, start_p, trans_p, emit_p)
+    paths, log_probs = model.viterbi([("normal", "cold"), ("dizzy",)])
+"""
+import numpy as np
+
+
+def _log(probabilities):
+    """
+    natural log of probabilities as float64, -inf for zero.
+    """
+    with np.errstate(divide="ignore"):
+        return np.log(np.asarray(probabilities, dtype=np.float64))
+
+
+def _index_dtype(states):
+    """
+    smallest unsigned integer type which can hold every state number.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if states <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+def viterbi_batch(log_emissions, log_start, log_trans, lengths=None):
+    """
+    finds the most likely path of states of each sequence in a batch.
+    Where paths are equally likely the one through the lowest numbered
+    states is taken.
+    :param log_emissions: log probability of each state emitting the
+    observation of each event, in the form (sequences, events, states), or
+    (events, states) for one sequence. Sequences shorter than the longest
+    are padded at the end.
+    :param log_start: log probability of starting in each state
+    :param log_trans: log probability of each transition, indexed
+    [prev_st][st]
+    :param lengths: number of events in each sequence, by default all events
+    :type log_emissions: numpy array
+    :type log_start: numpy array
+    :type log_trans: numpy array
+    :type lengths: numpy array / list
+    returns the paths as an array of state numbers in the form
+    (sequences, events), with the padding of short sequences holding their
+    last state, and the log probability of each path. For one sequence the
+    path and its log probability.
+    """
+    log_emissions = np.asarray(log_emissions, dtype=np.float64)
+    if log_emissions.ndim == 2:
+        paths, log_probs = viterbi_batch(
+            log_emissions[None], log_start, log_trans)
+        return paths[0], log_probs[0]
+    sequences, events, states = log_emissions.shape
+    log_start = np.asarray(log_start, dtype=np.float64)
+    log_trans = np.asarray(log_trans, dtype=np.float64)
+    if lengths is None:
+        lengths = np.full(sequences, events)
+    lengths = np.asarray(lengths)
+    rows = np.arange(sequences)
+    # B[t] holds the state at event t-1 on the best path in to each state at
+    # event t. Past the end of a sequence each state leads back to itself,
+    # so the traceback passes through the padding unchanged.
+    B = np.empty((events, sequences, states), dtype=_index_dtype(states))
+    B[0] = 0
+    V = log_start + log_emissions[:, 0]
+    for t in range(1, events):
+        # scores[n, prev_st, st]
+        scores = V[:, :, None] + log_trans
+        best = np.argmax(scores, axis=1)
+        new_V = np.take_along_axis(scores, best[:, None], axis=1)[:, 0]
+        new_V += log_emissions[:, t]
+        ended = t >= lengths
+        if ended.any():
+            best[ended] = np.arange(states)
+            new_V[ended] = V[ended]
+        B[t] = best
+        V = new_V
+    paths = np.empty((sequences, events), dtype=np.int64)
+    paths[:, -1] = np.argmax(V, axis=1)
+    log_probs = V[rows, paths[:, -1]]
+    for t in range(events - 1, 0, -1):
+        paths[:, t - 1] = B[t, rows, paths[:, t]]
+    return paths, log_probs
+
+
+class HMM:
+    """
+    a hidden markov model with named states and observations.
+    """
+    def __init__(self, states, start_p, trans_p, emit_p, observations=None):
+        """
+        :param states: names of the states
+        :param start_p: probability of starting in each state, as a
+        dictionary keyed by state or a sequence in the order of states
+        :param trans_p: probability of each transition, as a dictionary of
+        dictionaries keyed [prev_st][st] or a (states, states) array
+        :param emit_p: probability of each state emitting each observation,
+        as a dictionary of dictionaries keyed [st][observation] or a
+        (states, observations) array
+        :param observations: names of the observations, by default the keys
+        of emit_p in the order first seen. Needed if emit_p is an array.
+        :type states: sequence
+        :type start_p: dictionary / sequence
+        :type trans_p: dictionary / numpy array
+        :type emit_p: dictionary / numpy array
+        :type observations: sequence
+        """
+        self.states = list(states)
+        if observations is None:
+            observations = []
+            for st in self.states:
+                for observation in emit_p[st]:
+                    if observation not in observations:
+                        observations.append(observation)
+        self.observations = list(observations)
+        self.state_numbers = {st: i for i, st in enumerate(self.states)}
+        self.observation_numbers = {
+            observation: i for i, observation in enumerate(self.observations)}
+        self.log_start = _log(self._vector(start_p))
+        self.log_trans = _log(self._matrix(trans_p, self.states))
+        self.log_emit = _log(self._matrix(emit_p, self.observations))
+
+    def _vector(self, probabilities):
+        if isinstance(probabilities, dict):
+            return [probabilities.get(st, 0) for st in self.states]
+        return probabilities
+
+    def _matrix(self, probabilities, columns):
+        if isinstance(probabilities, dict):
+            return [[probabilities[st].get(column, 0) for column in columns]
+                    for st in self.states]
+        return probabilities
+
+    def encode(self, sequence):
+        """
+        the observation numbers of a sequence of observations.
+        """
+        return np.array([self.observation_numbers[observation]
+                         for observation in sequence], dtype=np.int64)
+
+    def viterbi(self, sequences):
+        """
+        finds the most likely path of states for each sequence of
+        observations, decoding them together.
+        :param sequences: sequences of observations, which can differ in
+        length
+        :type sequences: list
+        returns a list with the path of state names of each sequence, and
+        an array of the log probability of each path
+        """
+        encoded = [self.encode(sequence) for sequence in sequences]
+        if not encoded:
+            return [], np.empty(0)
+        lengths = np.array([len(sequence) for sequence in encoded])
+        events = max(lengths.max(), 1)
+        padded = np.zeros((len(encoded), events), dtype=np.int64)
+        for row, sequence in zip(padded, encoded):
+            row[:len(sequence)] = sequence
+        # log_emissions[n, t, st]
+        log_emissions = self.log_emit.T[padded]
+        paths, log_probs = viterbi_batch(
+            log_emissions, self.log_start, self.log_trans, lengths)
+        named = [[self.states[st] for st in path[:length]]
+                 for path, length in zip(paths.tolist(), lengths)]
+        return named, log_probs
@@ -0,0 +1,179 @@
+"""
+opt in timing of the stages of basecalling, i.e. loading the data, loading
+the model, inference, softmax, the dynamic programming, the traceback and
+stitching kmers together. Nothing is recorded until enable is called, so
+the stages cost one function call each otherwise.
+Each stage records the time taken, the reads and events it handled, their
+throughput and the peak resident memory of the process so far. The records
+can be written as JSON lines, or printed as a summary table with a row
+per stage.
+
+    instrumentation.enable()
+    with instrumentation.stage("dp", reads=1, events=len(posterior[0])):
+        V, B, T = stays.viterbi_numpy(posterior, stays.transition)
+    print(instrumentation.summary())
+"""
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+
+_recorder = None
+
+
+class Recorder:
+    """
+    the records of every stage run since enable was called.
+    """
+    def __init__(self):
+        self.records = []
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+
+def enable():
+    """
+    starts recording stages, dropping any earlier records.
+    """
+    global _recorder
+    _recorder = Recorder()
+
+
+def disable():
+    """
+    stops recording stages.
+    """
+    global _recorder
+    _recorder = None
+
+
+def enabled():
+    """
+    returns whether stages are being recorded.
+    """
+    return _recorder is not None
+
+
+def stage(name, reads=None, events=None, device=None):
+    """
+    context manager recording the stage run inside it.
+    :param name: name of the stage, e.g. "inference"
+    :param reads: number of reads handled by the stage
+    :param events: number of events handled by the stage, over all reads
+    :param device: device the stage runs on. Work queued on a cuda device
+    is waited for, so that it is timed in this stage.
+    :type name: string
+    :type reads: int
+    :type events: int
+    :type device: string
+    """
+    if _recorder is None:
+        return contextlib.nullcontext()
+    return _timed(_recorder, name, reads, events, device)
+
+
+@contextlib.contextmanager
+def _timed(recorder, name, reads, events, device):
+    start_time = time.perf_counter()
+    yield
+    if device is not None and str(device).startswith("cuda"):
+        import torch
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start_time
+    record = {
+        "stage": name,
+        "start": start_time - recorder.start_time,
+        "seconds": seconds,
+        "reads": reads,
+        "events": events,
+        "peak_rss_bytes": peak_rss(),
+    }
+    if reads is not None and seconds > 0:
+        record["reads_per_second"] = reads / seconds
+    if events is not None and seconds > 0:
+        record["events_per_second"] = events / seconds
+    recorder.add(record)
+
+
+def peak_rss():
+    """
+    peak resident memory of this process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, mac os bytes
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def records():
+    """
+    returns a list with a dictionary for each stage recorded.
+    """
+    if _recorder is None:
+        return []
+    with _recorder.lock:
+        return list(_recorder.records)
+
+
+def write_jsonl(path):
+    """
+    appends the records to a file as JSON lines, one per stage run.
+    """
+    with open(path, "a") as f:
+        for record in records():
+            f.write(json.dumps(record) + "\n")
+
+
+def summary():
+    """
+    the records totalled for each stage, as a table in the order the
+    stages were first run. The share is of the time since enable was
+    called. Stages can run inside one another, e.g. building the
+    transitions inside the first dp, so the shares can add up to more than
+    100%.
+    returns the table as a string
+    """
+    totals = {}
+    for record in records():
+        total = totals.setdefault(record["stage"], {
+            "runs": 0, "seconds": 0.0, "reads": 0, "events": 0,
+            "peak_rss_bytes": 0})
+        total["runs"] += 1
+        total["seconds"] += record["seconds"]
+        total["reads"] += record["reads"] or 0
+        total["events"] += record["events"] or 0
+        total["peak_rss_bytes"] = max(
+            total["peak_rss_bytes"], record["peak_rss_bytes"])
+    all_seconds = 0
+    if _recorder is not None:
+        all_seconds = time.perf_counter() - _recorder.start_time
+    lines = ["{:<12} {:>5} {:>10} {:>6} {:>8} {:>12} {:>12} {:>10}".format(
+        "stage", "runs", "seconds", "share", "reads", "reads/s",
+        "events/s", "peak MB")]
+    for name, total in totals.items():
+        seconds = total["seconds"]
+        lines.append(
+            "{:<12} {:>5} {:>10.3f} {:>5.1f}% {:>8} {:>12} {:>12} "
+            "{:>10.1f}".format(
+                name, total["runs"], seconds,
+                100 * seconds / all_seconds if all_seconds else 0,
+                total["reads"] or "", _rate(total["reads"], seconds),
+                _rate(total["events"], seconds),
+                total["peak_rss_bytes"] / 2**20))
+    return "\n".join(lines)
+
+
+def _rate(count, seconds):
+    """
+    count per second for the summary table, blank if nothing was counted.
+    """
+    if not count or not seconds:
+        return ""
+    return "{:.1f}".format(count / seconds)
@@ -0,0 +1,111 @@
+"""
+numba compiled kernels for the stays decoder, used by the numba engine and
+by determine_path when numba is installed. The per event update and the
+traceback are written as plain loops over the states, so the stay or step
+comparison for each state is made as it is in viterbi, without the
+temporary arrays the numpy version needs.
+numba is optional, available is False when it is not installed and the
+callers fall back to numpy. The compiled kernels are cached on disk, in
+__pycache__ next to this file or in NUMBA_CACHE_DIR if that is set, so
+later runs and basecall_parallel workers load them rather than compiling
+them again.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+
+
+def _jit(function):
+    """
+    compiles a function with numba, caching it on disk, or leaves it as
+    python when numba is not installed.
+    """
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@_jit
+def viterbi_step(V_prev, log_posterior, prev_states, prev_trans, stay_trans,
+                 log_prev_trans, log_stay_trans, V, B, T, empty_state,
+                 empty_transition):
+    """
+    advances one read by one event, as _viterbi_step. Writes the new
+    column of the dynamic programming table in to V, and the columns of the
+    backtrace and transitions tables in to B and T.
+    :param V_prev: log probabilities of the previous event, (states-1,)
+    :param log_posterior: log posteriors of this event, (states,)
+    :param prev_states: prev_states from predecessor_arrays
+    :param prev_trans: prev_trans from predecessor_arrays
+    :param stay_trans: stay_trans from predecessor_arrays
+    :param log_prev_trans: log probabilities of prev_trans
+    :param log_stay_trans: log probabilities of stay_trans
+    :param V: output column of the dynamic programming table, (states-1,)
+    :param B: output column of the backtrace table, (states-1,)
+    :param T: output column of the transitions table, (states-1,)
+    :param empty_state: value for an empty slot of B
+    :param empty_transition: value for an empty slot of T
+    """
+    width, predecessors = prev_states.shape
+    log_stay_posterior = log_posterior[0]
+    for row in range(width):
+        # the first most likely step or skip, padding is never chosen as
+        # its log probability is -inf
+        best_prob = -np.inf
+        best = -1
+        for j in range(predecessors):
+            prev_st = prev_states[row, j]
+            if prev_st == 0:
+                continue
+            prob = V_prev[prev_st - 1] + log_prev_trans[row, j]
+            if best == -1 or prob > best_prob:
+                best_prob = prob
+                best = j
+        step = best_prob + log_posterior[row + 1]
+        stay = V_prev[row] + log_stay_trans[row] + log_stay_posterior
+        # a step or skip only replaces the stay if it is strictly more
+        # likely, as in viterbi
+        if step > stay:
+            V[row] = step
+            B[row] = prev_states[row, best]
+            T[row] = prev_trans[row, best]
+        else:
+            V[row] = stay
+            if stay > -np.inf:
+                B[row] = row + 1
+                T[row] = stay_trans[row]
+            else:
+                B[row] = empty_state
+                T[row] = empty_transition
+
+
+@_jit
+def traceback(last_V, B, T, empty_state):
+    """
+    traces the most likely path back through a backtrace table, as
+    determine_path.
+    :param last_V: last column of the dynamic programming table
+    :param B: backtrace table, (states-1, events-1)
+    :param T: transitions table, (states-1, events-1)
+    :param empty_state: value of an empty slot of B
+    returns the path and transitions as int64 arrays, and the event of the
+    first empty slot reached, or -1 if there is none
+    """
+    events = B.shape[1]
+    path = np.empty(events + 1, dtype=np.int64)
+    transitions = np.empty(events, dtype=np.int64)
+    kmer = np.argmax(last_V) + 1
+    path[events] = kmer
+    for t in range(events - 1, -1, -1):
+        previous_kmer = B[kmer - 1, t]
+        if previous_kmer == empty_state:
+            return path, transitions, t
+        transitions[t] = T[kmer - 1, t]
+        kmer = previous_kmer
+        path[t] = kmer
+    return path, transitions, -1
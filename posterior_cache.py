@@ -0,0 +1,203 @@
+"""
+caches the posteriors produced by the model on disk, so that decoding the
+same chunks again, e.g. while tuning transition_dict or the decoder, does
+not put them through the network again.
+Each chunk is saved as its own .npy file under a directory named after a
+hash of the model weights, the model class and the sample grouping, and is
+read back memory mapped, so only the parts a decoder touches are loaded.
+The cache can be limited in bytes and in number of chunks, dropping the
+least recently used chunks, or the oldest, once it grows past the limits.
+"""
+import os
+import hashlib
+import numpy as np
+import instrumentation
+from utils import get_posteriors, as_posterior_array
+
+# hashes of files already read, keyed by path, size and modification time
+_file_hashes = {}
+
+
+def _file_hash(path):
+    """
+    sha256 of the contents of a file, only read again if it changes.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def model_key(model_class_path, model_path, sample_grouping=5, dataset=None):
+    """
+    the name posteriors from a model are cached under.
+    :param model_class_path: path to model class
+    :param model_path: path pickle of train model
+    :param sample_grouping: the number of samples which will get
+    classifed in to one kmer
+    :param dataset: name of the data the chunk indices refer to, such as
+    the hdf5 file, so that the same index in different files is kept apart
+    :type model_class_path: string
+    :type model_path: string
+    :type sample_grouping: int
+    :type dataset: string
+    returns the key as a hex string
+    """
+    digest = hashlib.sha256()
+    digest.update(_file_hash(model_path).encode())
+    digest.update(_file_hash(model_class_path).encode())
+    digest.update(str(sample_grouping).encode())
+    if dataset is not None:
+        digest.update(os.path.abspath(dataset).encode())
+    return digest.hexdigest()[:32]
+
+
+class PosteriorCache:
+    """
+    posteriors saved as one .npy file per model and chunk in a directory.
+    """
+    def __init__(self, directory, max_bytes=None, max_entries=None,
+                 eviction="lru"):
+        """
+        :param directory: directory the posteriors are saved in
+        :param max_bytes: size the cache is kept under, unlimited by default
+        :param max_entries: number of chunks the cache is kept under,
+        unlimited by default
+        :param eviction: "lru" to drop the least recently read chunks first,
+        or "fifo" to drop the first saved
+        :type directory: string
+        :type max_bytes: int
+        :type max_entries: int
+        :type eviction: string
+        """
+        if eviction not in ("lru", "fifo"):
+            raise ValueError("eviction must be lru or fifo")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.eviction = eviction
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, index):
+        """
+        file the posteriors of a chunk are saved in.
+        """
+        return os.path.join(self.directory, key, "{}.npy".format(index))
+
+    def get(self, key, index):
+        """
+        the posteriors of a chunk, memory mapped in the form
+        (states, events), or None if they are not cached.
+        """
+        path = self.path(key, index)
+        try:
+            posterior = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        if self.eviction == "lru":
+            # the modification time orders the chunks for eviction
+            os.utime(path)
+        return posterior
+
+    def put(self, key, index, posterior):
+        """
+        saves the posteriors of a chunk, then evicts chunks if the cache is
+        over its limits.
+        """
+        path = self.path(key, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under another name and moved in to place, so a reader
+        # never sees half a file
+        temp_path = "{}.{}.tmp.npy".format(path[:-4], os.getpid())
+        np.save(temp_path, as_posterior_array(posterior))
+        os.replace(temp_path, path)
+        self.evict()
+
+    def entries(self):
+        """
+        the cached chunks, as a list of (modification time, bytes, path)
+        in the order they would be evicted.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            key_directory = os.path.join(self.directory, key)
+            if not os.path.isdir(key_directory):
+                continue
+            for name in os.listdir(key_directory):
+                if not name.endswith(".npy") or ".tmp." in name:
+                    continue
+                path = os.path.join(key_directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        removes chunks until the cache is within max_bytes and max_entries.
+        """
+        if self.max_bytes is None and self.max_entries is None:
+            return
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        count = len(entries)
+        for mtime, size, path in entries:
+            over_bytes = self.max_bytes is not None and total > self.max_bytes
+            over_entries = (
+                self.max_entries is not None and count > self.max_entries)
+            if not (over_bytes or over_entries):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
+
+    def posteriors(self, data, indices, model_class_path, model_path,
+                   sample_grouping=5, dataset=None):
+        """
+        the posteriors for each chunk of data, reading those already cached
+        and putting the rest through the model together.
+        :param data: data to be inputted in to model in form NHC
+        :param indices: index of each chunk of data in the data set, e.g.
+        from load_training_data with return_indices
+        :param model_class_path: path to model class
+        :param model_path: path pickle of train model
+        :param sample_grouping: the number of samples which will get
+        classifed in to one kmer
+        :param dataset: name of the data set, see model_key
+        :type data: numpy array
+        :type indices: numpy array / list
+        :type model_class_path: string
+        :type model_path: string
+        :type sample_grouping: int
+        :type dataset: string
+        returns a list with the posteriors of each chunk in the form
+        (states, events). Cached chunks are memory mapped and read as they
+        are used.
+        """
+        key = model_key(
+            model_class_path, model_path, sample_grouping, dataset=dataset)
+        indices = [int(index) for index in indices]
+        with instrumentation.stage("posterior_cache", reads=len(indices)):
+            posteriors = [self.get(key, index) for index in indices]
+        missing = [row for row, posterior in enumerate(posteriors)
+                   if posterior is None]
+        if missing:
+            computed = as_posterior_array(get_posteriors(
+                data[missing], model_class_path, model_path,
+                sample_grouping))
+            for row, posterior in zip(missing, computed):
+                self.put(key, indices[row], posterior)
+                posteriors[row] = posterior
+        return posteriors
@@ -0,0 +1,358 @@
+"""
+compact formats for posteriors, which keep the log probabilities in fewer
+bits than the float32 output of get_posteriors. The decoders read them a
+column at a time through log_column, so a read is never expanded back to
+floats as a whole.
+
+uint8: each log probability is stored as
+    code = round(-log(p) * scale)
+clipped to 0 - 254, and read back as -code / scale. Probabilities of zero
+are stored as 255 and read back as -inf. By default the scale is chosen
+for each event from its range, 254 / -(smallest log probability), so the
+least likely state of the event is code 254 and nothing is clipped. The
+scales are kept as float32 alongside the codes, adding 4 bytes an event.
+A fixed scale can be given instead, which clips anything below
+exp(-254 / scale).
+
+float16: each log probability is stored as a float16, which keeps about
+three significant figures. Zero probabilities are stored as -inf.
+
+sparse: only the most likely states of each event, and the stay state, are
+kept, as their state numbers and float32 log probabilities in compressed
+sparse row form, and every other state is taken to have a probability of
+zero. See sparsify and viterbi_basecall_tools_stays.viterbi_sparse_posterior.
+"""
+import time
+import numpy as np
+from utils import as_posterior_array
+import viterbi_basecall_tools_stays as stays
+
+# code of a zero probability in the uint8 format
+ZERO_CODE = 255
+# largest scale chosen for an event, for events whose states are all close
+# to certain
+MAX_SCALE = 1024
+
+
+class QuantizedPosteriors:
+    """
+    posteriors in one of the compact formats. Indexing works as on the
+    array the posteriors came from and gives QuantizedPosteriors, so a read
+    of a batch, e.g. posteriors[0], is in the same format.
+    """
+    def __init__(self, data, scale=None):
+        """
+        :param data: the stored codes, uint8 or float16
+        :param scale: codes per unit of log probability, for uint8. Either
+        one scale, or an array which broadcasts against data, e.g. one
+        scale for each event in the form (reads, 1, events).
+        :type data: numpy array
+        :type scale: float / numpy array
+        """
+        self.data = data
+        self.scale = scale
+        if data.dtype == np.uint8 and np.ndim(scale) == 0:
+            # log probability of each code
+            self.table = -np.arange(256) / scale
+            self.table[ZERO_CODE] = -np.inf
+        else:
+            self.table = None
+
+    def _scales(self):
+        """
+        the scale of every code, as a read only view the shape of data.
+        """
+        return np.broadcast_to(self.scale, self.data.shape)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def nbytes(self):
+        if self.scale is None or np.ndim(self.scale) == 0:
+            return self.data.nbytes
+        return self.data.nbytes + self.scale.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        scale = self.scale
+        if scale is not None and np.ndim(scale) > 0:
+            scale = _unbroadcast(self._scales()[index])
+        return QuantizedPosteriors(self.data[index], scale=scale)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def log_column(self, t):
+        """
+        the log probabilities of event t as float64, i.e. data[..., t]
+        decoded.
+        """
+        column = self.data[..., t]
+        if self.table is not None:
+            return self.table[column]
+        if self.scale is None:
+            return column.astype(np.float64)
+        return self._decode(column, self._scales()[..., t])
+
+    def log_probabilities(self):
+        """
+        every log probability decoded to float64, for inspecting the
+        posteriors rather than decoding them.
+        """
+        if self.table is not None:
+            return self.table[self.data]
+        if self.scale is None:
+            return self.data.astype(np.float64)
+        return self._decode(self.data, self._scales())
+
+    @staticmethod
+    def _decode(codes, scales):
+        """
+        log probabilities of uint8 codes with their scales.
+        """
+        log_probs = codes / -scales.astype(np.float64)
+        log_probs[codes == ZERO_CODE] = -np.inf
+        return log_probs
+
+    def save(self, path):
+        """
+        saves the posteriors as an .npz file.
+        """
+        scale = np.nan if self.scale is None else self.scale
+        np.savez(path, data=self.data, scale=scale)
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads posteriors saved by save.
+        """
+        with np.load(path) as saved:
+            scale = saved["scale"]
+            if scale.ndim == 0:
+                scale = float(scale)
+                if np.isnan(scale):
+                    scale = None
+            return cls(saved["data"], scale=scale)
+
+
+def _unbroadcast(array):
+    """
+    a copy of an array keeping only one value along each axis it is
+    broadcast along, so a view of the scales of a read stores one scale
+    per event rather than one per code.
+    """
+    index = tuple(slice(0, 1) if stride == 0 else slice(None)
+                  for stride in array.strides)
+    return array[index].copy()
+
+
+def quantize(posteriors, dtype="uint8", scale=None):
+    """
+    converts posteriors, e.g. the output of get_posteriors, to a compact
+    format. One read is converted at a time, so only one read is held as
+    floats at once.
+    :param posteriors: posterior probabilities, (states, events) or
+    (reads, states, events)
+    :param dtype: "uint8" or "float16"
+    :param scale: codes per unit of log probability, for uint8. By default
+    it is chosen for each event from the range of its log probabilities
+    :type posteriors: numpy array / torch tensor
+    :type dtype: string
+    :type scale: float
+    returns QuantizedPosteriors
+    """
+    if dtype not in ("uint8", "float16"):
+        raise ValueError("dtype must be uint8 or float16")
+    posteriors = as_posterior_array(posteriors)
+    data = np.empty(posteriors.shape, dtype=dtype)
+    reads = posteriors if posteriors.ndim == 3 else [posteriors]
+    stored = data if posteriors.ndim == 3 else [data]
+    scales = None
+    stored_scales = [None] * len(reads)
+    if dtype == "uint8" and scale is None:
+        # one scale for each event, broadcast over the states
+        scales = np.empty(
+            posteriors.shape[:-2] + (1, posteriors.shape[-1]),
+            dtype=np.float32)
+        stored_scales = scales if posteriors.ndim == 3 else [scales]
+    for read, out, out_scale in zip(reads, stored, stored_scales):
+        with np.errstate(divide="ignore"):
+            log_probs = np.log(read, dtype=np.float64)
+        if dtype == "float16":
+            out[:] = log_probs
+            continue
+        zero = np.isneginf(log_probs)
+        read_scale = scale
+        if out_scale is not None:
+            # the least likely state of each event gets the last code
+            lowest = np.where(zero, 0, log_probs).min(axis=0)
+            out_scale[0] = (ZERO_CODE - 1) / np.maximum(
+                -lowest, (ZERO_CODE - 1) / MAX_SCALE)
+            read_scale = out_scale.astype(np.float64)
+        codes = np.clip(
+            np.rint(-log_probs * read_scale), 0, ZERO_CODE - 1)
+        codes[zero] = ZERO_CODE
+        out[:] = codes
+    if dtype == "float16":
+        scale = None
+    elif scales is not None:
+        scale = scales
+    return QuantizedPosteriors(data, scale=scale)
+
+
+def accuracy_report(posteriors, transition_func,
+                    transition_dict=stays.transition_dict, k=5,
+                    formats=(("float16", None), ("uint8", None),
+                             ("uint8", 16))):
+    """
+    compares decoding each compact format with decoding the float posteriors
+    of a batch of reads.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events)
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param formats: (dtype, scale) of each format to try, a scale of None
+    for uint8 choosing one for each event
+    :type posteriors: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type formats: tuple
+    returns a list with a dictionary for each format, holding its size
+    relative to float32, the time taken to decode and the fractions from
+    viterbi_basecall_tools_stays.compare_paths, along with a dictionary for
+    the float path.
+    """
+    posteriors = as_posterior_array(posteriors)
+    float_bytes = posteriors.size * 4
+
+    def decode(batch):
+        start_time = time.time()
+        results = stays.decode_batch(
+            batch, transition_func, transition_dict=transition_dict, k=k)
+        return results, time.time() - start_time
+
+    exact, seconds = decode(posteriors)
+    report = [{"format": "float", "bytes": float_bytes, "size": 1.0,
+               "seconds": seconds,
+               **stays.compare_paths(exact, exact, k=k)}]
+    for dtype, scale in formats:
+        quantized = quantize(posteriors, dtype=dtype, scale=scale)
+        results, seconds = decode(quantized)
+        if scale is not None:
+            name = "{} scale={}".format(dtype, scale)
+        elif dtype == "uint8":
+            name = "uint8 scale per event"
+        else:
+            name = dtype
+        report.append({
+            "format": name, "bytes": quantized.nbytes,
+            "size": quantized.nbytes / float_bytes, "seconds": seconds,
+            **stays.compare_paths(results, exact, k=k)})
+    return report
+
+
+class SparsePosteriors:
+    """
+    the posteriors of one read with only some states kept for each event.
+    The states kept for event t are states[indptr[t]:indptr[t+1]], in
+    ascending order, with their log probabilities in log_probs.
+    """
+    def __init__(self, indptr, states, log_probs, number_of_states):
+        """
+        :param indptr: start of each event in states and log_probs
+        :param states: state numbers kept
+        :param log_probs: log probabilities of the states kept
+        :param number_of_states: number of states including the stay state
+        :type indptr: numpy array
+        :type states: numpy array
+        :type log_probs: numpy array
+        :type number_of_states: int
+        """
+        self.indptr = indptr
+        self.states = states
+        self.log_probs = log_probs
+        self.number_of_states = number_of_states
+
+    @property
+    def shape(self):
+        return self.number_of_states, len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return (self.indptr.nbytes + self.states.nbytes +
+                self.log_probs.nbytes)
+
+    def column(self, t):
+        """
+        the states kept for event t and their log probabilities.
+        """
+        start, end = self.indptr[t], self.indptr[t + 1]
+        return self.states[start:end], self.log_probs[start:end]
+
+    def log_column(self, t):
+        """
+        the log probabilities of every state at event t as float64, -inf
+        for the states which were not kept.
+        """
+        column = np.full(self.number_of_states, -np.inf)
+        states, log_probs = self.column(t)
+        column[states] = log_probs
+        return column
+
+
+def sparsify(posteriors, top_k=None, floor=None):
+    """
+    keeps the top_k most likely states of each event, and or those with a
+    probability of at least floor. The most likely state and the stay state
+    are always kept, so every state alive at one event can stay at the next
+    and viterbi_sparse_posterior never runs out of states where
+    viterbi_numpy would not.
+    :param posteriors: posterior probabilities, (states, events) or
+    (reads, states, events)
+    :param top_k: number of states to keep for each event
+    :param floor: smallest probability kept
+    :type posteriors: numpy array / torch tensor
+    :type top_k: int
+    :type floor: float
+    returns SparsePosteriors, or a list of them for a batch of reads
+    """
+    if top_k is None and floor is None:
+        raise ValueError("give top_k or floor")
+    posteriors = as_posterior_array(posteriors)
+    if posteriors.ndim == 3:
+        return [sparsify(posterior, top_k=top_k, floor=floor)
+                for posterior in posteriors]
+    states, events = posteriors.shape
+    event_index = np.arange(events)
+    keep = np.ones((states, events), dtype=bool)
+    if top_k is not None and top_k < states:
+        keep[:] = False
+        top = np.argpartition(posteriors, -top_k, axis=0)[-top_k:]
+        keep[top, event_index] = True
+    if floor is not None:
+        keep &= posteriors >= floor
+    keep[np.argmax(posteriors, axis=0), event_index] = True
+    keep[0] = True
+    # events first, so each event's states are together and in order
+    kept_events, kept_states = np.nonzero(keep.T)
+    indptr = np.zeros(events + 1, dtype=np.int64)
+    np.cumsum(keep.sum(axis=0), out=indptr[1:])
+    with np.errstate(divide="ignore"):
+        log_probs = np.log(
+            posteriors[kept_states, kept_events], dtype=np.float64)
+    return SparsePosteriors(
+        indptr, kept_states.astype(stays.state_dtype(states)),
+        log_probs.astype(np.float32), states)
@@ -1,12 +1,19 @@
 """
 script to print and visualise transition probabilities
 """
+import numpy as np
+from transition_cache import transition_structure
+import viterbi_basecall_tools_stays as stays
 
-from utils import transition
-kmer = [(i+1) for i in range(64)]
-probs = [[transition(j, i) for i in kmer] for j in kmer]
+# 3mers, 64 kmers and the stay state
+structure = transition_structure(stays.transition, k=3, states=4**3 + 1)
+# transition integers from each kmer (rows) to each kmer (columns)
+trans_ints = structure.dense()[1:, 1:].T
+probs = np.zeros(trans_ints.shape)
+for trans_int, prob in stays.transition_dict.items():
+    probs[trans_ints == trans_int] = prob
 
 for i in range(len(probs)):
     print(sum(probs[i]))
 for i in range(len(probs)):
-    print(probs[i])
+    print(probs[i].tolist())
@@ -1,20 +1,110 @@
 import time
 import argparse
 import numpy as np
-from utils import load_training_data, number_to_kmer, get_posteriors, number_to_kmer_nostay
+from utils import load_training_data, get_posteriors
+from utils import numbers_to_kmers, numbers_to_kmers_nostay
+from utils import ImpossibleTransitionError
 import viterbi_basecall_tools_basic as basic
 import viterbi_basecall_tools_stays as stays
+import transition_cache
+import instrumentation
+from basecall_parallel import basecall_pipelined, basecall_reads
+from basecall_parallel import decode_windows, window_report
+from posterior_cache import PosteriorCache
+import posterior_formats
 # A G T C posterior probabilities for three reads
 posteriors = [
     [0.3, 0.2, 0.3], [0.1, 0.4, 0.2], [0.2, 0.2, 0.1], [0.4, 0.2, 0.4]]
 parser = argparse.ArgumentParser()
 parser.add_argument("-m", "--mode", type=str,
-                    choices=["r", "e1", "e2", "e3", "e4"], default="e1",
+                    choices=["r", "rb", "rq", "rw", "e1", "e2", "e3", "e4"],
+                    default="e1",
                     dest="mode", help='list of options on examples',
                     required=True)
+parser.add_argument("-e", "--engine", type=str,
+                    choices=["python", "sparse", "numpy", "numba",
+                             "checkpoint", "sparse_posterior"],
+                    default="python",
+                    dest="engine", help='decoder used to find the path')
+parser.add_argument("-l", "--log-space", action="store_true",
+                    dest="log_space",
+                    help='decode with log probabilities (python and sparse '
+                    'engines, numpy always does)')
+parser.add_argument("-c", "--compact", action="store_true",
+                    dest="compact",
+                    help='store the tables as typed numpy arrays (python and '
+                    'sparse engines, numpy always does)')
+parser.add_argument("--top-k", type=int, default=32, dest="top_k",
+                    help='states kept for each event by the '
+                    'sparse_posterior engine')
+parser.add_argument("--floor", type=float, default=None, dest="floor",
+                    help='smallest posterior probability kept by the '
+                    'sparse_posterior engine')
+parser.add_argument("-q", "--qualities", action="store_true",
+                    dest="qualities",
+                    help='in mode r with the numpy engine and mode e3, also '
+                    'print a Phred quality for each base, from the forward '
+                    'backward probabilities')
+parser.add_argument("-w", "--workers", type=int, default=0, dest="workers",
+                    help='in mode r, basecall the reads on this many worker '
+                    'processes')
+parser.add_argument("--window", type=int, default=None, dest="window",
+                    help='in mode r, decode the read in overlapping windows '
+                    'of this many events at once, on -w threads')
+parser.add_argument("--overlap", type=int, default=100, dest="overlap",
+                    help='events each window shares with the next')
+parser.add_argument("--window-processes", action="store_true",
+                    dest="window_processes",
+                    help='decode the windows on processes rather than '
+                    'threads')
+parser.add_argument("--chunk-size", type=int, default=1, dest="chunk_size",
+                    help='reads handed to a worker at a time')
+parser.add_argument("--batch-size", type=int, default=8, dest="batch_size",
+                    help='reads put through the model at a time when using '
+                    'workers')
+parser.add_argument("--transition-cache", type=str, default=None,
+                    dest="transition_cache",
+                    help='directory to save the transition structures in, '
+                    'so later runs and workers load them')
+parser.add_argument("--posterior-cache", type=str, default=None,
+                    dest="posterior_cache",
+                    help='in mode r, directory to cache the posteriors of '
+                    'each chunk in, so later runs skip the model')
+parser.add_argument("--posterior-cache-size", type=int, default=None,
+                    dest="posterior_cache_size",
+                    help='megabytes the posterior cache is kept under, '
+                    'dropping the least recently used chunks')
+parser.add_argument("--metrics", type=str, nargs="?", const="",
+                    default=None, dest="metrics",
+                    help='time each stage and print a summary, also writing '
+                    'the timings as JSON lines to the file given')
 
-args = parser.parse_args()
-mode = args.mode
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.metrics is not None:
+        instrumentation.enable()
+    if args.transition_cache is not None:
+        transition_cache.set_cache_dir(args.transition_cache)
+    mode = args.mode
+    engine = args.engine
+    log_space = args.log_space
+    compact = args.compact
+    workers = args.workers
+    window = args.window
+    overlap = args.overlap
+    window_processes = args.window_processes
+    chunk_size = args.chunk_size
+    batch_size = args.batch_size
+    top_k = args.top_k
+    qualities = args.qualities
+    floor = args.floor
+    posterior_cache = args.posterior_cache
+    posterior_cache_size = args.posterior_cache_size
+    if posterior_cache_size is not None:
+        posterior_cache_size *= 2**20
+else:
+    # imported for find_path, e.g. by basecall_parallel workers
+    mode = None
 
 posteriors_stays = np.zeros((17, 4))
 posteriors_stays[1][0] = 0.9
@@ -29,19 +119,74 @@ posteriors_stays[5][2] = 0.1
 number_of_posteriors = 100
 
 
-def find_path(posteriors, labels):
-    print("posteriors shape:", len(posteriors), ",", len(posteriors[0]))
-    print("Determining viterbi path ...")
+def find_path(posteriors, labels, engine="python", log_space=False,
+              compact=False, verbose=True, top_k=32, floor=None):
+    if verbose:
+        print("posteriors shape:", len(posteriors), ",", len(posteriors[0]))
+        print("Determining viterbi path ...")
     start_time = time.time()
     number_of_posteriors = len(posteriors[0])
-    V, B, T = stays.viterbi(posteriors, stays.transition, k=5, norm_interval=4)
-    viterbi_path, transitions = stays.determine_path(V, B, T)
+    with instrumentation.stage("dp", reads=1, events=number_of_posteriors):
+        if engine == "sparse":
+            V, B, T = stays.viterbi_sparse(
+                posteriors, stays.transition, k=5, norm_interval=4,
+                log_space=log_space, compact=compact)
+        elif engine == "numpy":
+            V, B, T = stays.viterbi_numpy(posteriors, stays.transition, k=5)
+        elif engine == "numba":
+            V, B, T = stays.viterbi_numba(posteriors, stays.transition, k=5)
+        elif engine == "checkpoint":
+            V, checkpoints = stays.viterbi_checkpointed(
+                posteriors, stays.transition, k=5)
+        elif engine == "sparse_posterior":
+            sparse_posteriors = posterior_formats.sparsify(
+                posteriors, top_k=top_k, floor=floor)
+            V, B, T = stays.viterbi_sparse_posterior(
+                sparse_posteriors, stays.transition, k=5)
+        else:
+            V, B, T = stays.viterbi(
+                posteriors, stays.transition, k=5, norm_interval=4,
+                log_space=log_space, compact=compact)
+    with instrumentation.stage(
+            "traceback", reads=1, events=number_of_posteriors):
+        if engine == "checkpoint":
+            viterbi_path, transitions = stays.determine_path_checkpointed(
+                V, checkpoints)
+        else:
+            viterbi_path, transitions = stays.determine_path(V, B, T)
     end_time = time.time()
-    print(
-        "time taken to determine path: ", (end_time - start_time),
-        "num posteriors: ", number_of_posteriors)
+    if verbose:
+        print(
+            "time taken to determine path: ", (end_time - start_time),
+            "num posteriors: ", number_of_posteriors)
     return viterbi_path, transitions
 
+
+def find_paths(posteriors, qualities=False):
+    """
+    decodes every read in a batch of posteriors together with the numpy
+    engine. posteriors are in the form (reads, states, events). With
+    qualities, the quality of each event of the paths is found as well.
+    """
+    print("posteriors shape:", tuple(posteriors.shape))
+    print("Determining viterbi paths ...")
+    start_time = time.time()
+    results = stays.decode_batch(
+        posteriors, stays.transition, k=5, qualities=qualities)
+    end_time = time.time()
+    print(
+        "time taken to determine paths: ", (end_time - start_time),
+        "num reads: ", len(results))
+    return results
+
+
+def print_qualities(transitions, event_qualities):
+    """
+    prints the quality of each base of a sequence as a FASTQ quality line.
+    """
+    print("qualities:     ", stays.quality_string(
+        stays.base_qualities(transitions, event_qualities)))
+
 if mode == "r":
     """
     Loads data from a hdf5 file, produces posteriors by running the data
@@ -49,7 +194,10 @@ if mode == "r":
     algorithm, then strings the bases together in to a basecall.
     """
     # load some data from a random part of the data set
-    data, labels = load_training_data("../../r941_ch8000_5mer_stride5.h5", 10)
+    data_path = "../../r941_ch8000_5mer_stride5.h5"
+    with instrumentation.stage("hdf5_load", reads=10):
+        data, labels, indices = load_training_data(
+            data_path, 10, return_indices=True)
 
     print("labels shape", labels.shape)
     # put data through model and normalise
@@ -58,15 +206,151 @@ if mode == "r":
 
     print("data input shape and type", data.shape, type(data))
 
+    model_path = "../catfish/trained_models/rgrgr_e_40_60000.pt"
+    model_class_path = "../catfish/catfish/models/raw_rgrgr_mod_torch.py"
+    posteriors = None
+    if posterior_cache is not None:
+        # chunks decoded before are read from the cache rather than put
+        # through the model again
+        cache = PosteriorCache(
+            posterior_cache, max_bytes=posterior_cache_size)
+        posteriors = cache.posteriors(
+            data, indices, model_class_path, model_path, dataset=data_path)
+    if window is not None:
+        # decode the first read in overlapping windows at once
+        if posteriors is None:
+            posteriors = get_posteriors(data, model_class_path, model_path)
+        print("Determining viterbi path in windows ...")
+        start_time = time.time()
+        try:
+            path, transitions, redecoded = decode_windows(
+                posteriors[0], window=window, overlap=overlap,
+                workers=workers or None, processes=window_processes,
+                engine=engine, log_space=log_space, compact=compact)
+        except ImpossibleTransitionError as error:
+            print("read 0 :", error)
+        else:
+            print(
+                "time taken to determine path: ", time.time() - start_time,
+                "overlaps decoded again: ", redecoded)
+            with instrumentation.stage(
+                    "stitch", reads=1, events=len(path)):
+                sequence = stays.stitch_kmers(path, transitions)
+            print("final sequence:", sequence)
+    elif workers > 0:
+        # the workers' own stages are not recorded, only the whole
+        # basecall alongside the inference on this process
+        with instrumentation.stage("basecall", reads=len(data)):
+            if posteriors is None:
+                # basecall each read on a pool of worker processes, while
+                # the model produces the posteriors for the next batch
+                sequences = basecall_pipelined(
+                    data, model_class_path, model_path,
+                    batch_size=batch_size, workers=workers,
+                    chunk_size=chunk_size, engine=engine,
+                    log_space=log_space, compact=compact)
+            else:
+                sequences = basecall_reads(
+                    np.stack(posteriors), workers=workers,
+                    chunk_size=chunk_size, engine=engine,
+                    log_space=log_space, compact=compact)
+        for sequence in sequences:
+            print("final sequence:", sequence)
+    elif engine == "numpy":
+        # decode the whole batch at once
+        if posteriors is None:
+            posteriors = get_posteriors(data, model_class_path, model_path)
+        else:
+            posteriors = np.stack(posteriors)
+        for result in find_paths(posteriors, qualities=qualities):
+            if result is None:
+                continue
+            path, transitions = result[:2]
+            with instrumentation.stage(
+                    "stitch", reads=1, events=len(path)):
+                sequence = stays.stitch_kmers(path, transitions)
+            print("final sequence:", sequence)
+            if qualities:
+                print_qualities(transitions, result[2])
+    else:
+        if posteriors is None:
+            posteriors = get_posteriors(data, model_class_path, model_path)
+        # posteriors = posteriors[0][:, 0:number_of_posteriors]
+        posteriors = posteriors[0]
+        try:
+            path, transitions = find_path(
+                posteriors, labels, engine=engine, log_space=log_space,
+                compact=compact, top_k=top_k, floor=floor)
+        except ImpossibleTransitionError as error:
+            # only raised when decoding in log space
+            print("read 0 :", error)
+        else:
+            with instrumentation.stage(
+                    "stitch", reads=1, events=len(path)):
+                sequence = stays.stitch_kmers(path, transitions)
+            print("final sequence:", sequence)
+
+if mode == "rb":
+    """
+    Loads data from a hdf5 file and produces posteriors as in mode r, then
+    reports how often beam decoding gives a different path to exact decoding.
+    """
+    data, labels = load_training_data("../../r941_ch8000_5mer_stride5.h5", 10)
     model_path = "../catfish/trained_models/rgrgr_e_40_60000.pt"
     model_class_path = "../catfish/catfish/models/raw_rgrgr_mod_torch.py"
     posteriors = get_posteriors(data, model_class_path, model_path)
-    # posteriors = posteriors[0][:, 0:number_of_posteriors]
-    posteriors = posteriors[0]
-    path, transitions = find_path(posteriors, labels)
-    sequence = stays.stitch_kmers(path, transitions)
+    report = stays.beam_report(
+        posteriors, stays.transition, k=5, beam_widths=(16, 64, 256),
+        beam_thresholds=(5.0, 10.0))
+    for row in report:
+        print(
+            "{setting}: {seconds:.2f} s,"
+            " reads differing {reads_differing:.2f},"
+            " sequences differing {sequences_differing:.2f},"
+            " positions differing {positions_differing:.4f}".format(**row))
 
-    print("final sequence:", sequence)
+if mode == "rq":
+    """
+    Loads data from a hdf5 file and produces posteriors as in mode r, then
+    reports how often decoding the compact posterior formats gives a
+    different path to decoding the float posteriors.
+    """
+    data, labels = load_training_data("../../r941_ch8000_5mer_stride5.h5", 10)
+    model_path = "../catfish/trained_models/rgrgr_e_40_60000.pt"
+    model_class_path = "../catfish/catfish/models/raw_rgrgr_mod_torch.py"
+    posteriors = get_posteriors(data, model_class_path, model_path)
+    report = posterior_formats.accuracy_report(
+        posteriors, stays.transition, k=5)
+    for row in report:
+        print(
+            "{format}: {size:.2f} of float32, {seconds:.2f} s, reads "
+            "differing {reads_differing:.2f}, sequences differing "
+            "{sequences_differing:.2f}, positions differing "
+            "{positions_differing:.4f}".format(**row))
+
+if mode == "rw":
+    """
+    Loads data from a hdf5 file and produces posteriors as in mode r, then
+    reports how often decoding each read in overlapping windows gives a
+    different path to decoding the whole read.
+    """
+    data, labels = load_training_data("../../r941_ch8000_5mer_stride5.h5", 10)
+    model_path = "../catfish/trained_models/rgrgr_e_40_60000.pt"
+    model_class_path = "../catfish/catfish/models/raw_rgrgr_mod_torch.py"
+    posteriors = get_posteriors(data, model_class_path, model_path)
+    settings = ((100, 10), (100, 25), (200, 25))
+    if window is not None:
+        settings = ((window, overlap),)
+    report = window_report(
+        posteriors, settings=settings, workers=workers or None,
+        processes=window_processes, engine=engine, log_space=log_space,
+        compact=compact)
+    for row in report:
+        print(
+            "{setting}: {seconds:.2f} s, reads differing {reads_differing:.2f}"
+            ", sequences differing {sequences_differing:.2f}, positions "
+            "differing {positions_differing:.4f}, overlaps decoded again "
+            "{redecoded}".format(**row))
 
 if mode == "e1":
     """
@@ -97,7 +381,7 @@ if mode == "e1":
     print("number of posteriors:", number_of_posteriors)
     print(path)
     print("most likely path is:")
-    print([number_to_kmer_nostay(i, k=1) for i in path])
+    print(numbers_to_kmers_nostay(path, k=1).tolist())
     print("should be ['C', 'A', 'G']")
 
 
@@ -107,6 +391,11 @@ if mode == "e2":
     probabilities and transition function to calculates the most likely
     path of 2mers.
     """
+    if engine == "checkpoint":
+        # the example prints the backtrace table, which checkpoint never
+        # builds
+        parser.error("mode e2 prints the backtrace table, use another "
+                     "engine than checkpoint")
     print("example using stays")
     print(posteriors_stays)
     posteriors = posteriors_stays
@@ -115,7 +404,22 @@ if mode == "e2":
     number_of_posteriors = len(posteriors[0])
     print("Determining viterbi path ...")
     start_time = time.time()
-    V, B, T = stays.viterbi(posteriors, stays.transition, k=5, norm_interval=1)
+    if engine == "sparse":
+        V, B, T = stays.viterbi_sparse(
+            posteriors, stays.transition, k=5, norm_interval=1,
+            log_space=log_space, compact=compact)
+    elif engine == "numpy":
+        V, B, T = stays.viterbi_numpy(posteriors, stays.transition, k=5)
+    elif engine == "numba":
+        V, B, T = stays.viterbi_numba(posteriors, stays.transition, k=5)
+    elif engine == "sparse_posterior":
+        V, B, T = stays.viterbi_sparse_posterior(
+            posterior_formats.sparsify(posteriors, top_k=top_k, floor=floor),
+            stays.transition, k=5)
+    else:
+        V, B, T = stays.viterbi(
+            posteriors, stays.transition, k=5, norm_interval=1,
+            log_space=log_space, compact=compact)
     print("DP table")
     for i in range(len(V)):
         print(V[i])
@@ -128,7 +432,7 @@ if mode == "e2":
 
     viterbi_path, transition = stays.determine_path(V, B, T)
     end_time = time.time()
-    print("calculated path: ", [number_to_kmer(i, k=2) for i in viterbi_path])
+    print("calculated path: ", numbers_to_kmers(viterbi_path, k=2).tolist())
     print("should be ['AA', 'AA', 'AA', 'AC']")
     print(
         "time taken per posterior:",
@@ -157,10 +461,19 @@ if mode == "e3":
 
     labels = ["AAAAA", "AAAAG", "AAAGG", "AAGGC", "AAGGC", "AGGCA", "GCACC"]
     labels = [1, 0, 3, 11, 42, 0, 165, 582]
-    path, transitions = find_path(posteriors, labels)
-    sequence = stays.stitch_kmers(path, transitions)
+    if qualities:
+        path, transitions, event_qualities = find_paths(
+            np.array(posteriors)[np.newaxis], qualities=True)[0]
+    else:
+        path, transitions = find_path(
+            posteriors, labels, engine=engine, log_space=log_space,
+            compact=compact, top_k=top_k, floor=floor)
+    with instrumentation.stage("stitch", reads=1, events=len(path)):
+        sequence = stays.stitch_kmers(path, transitions)
 
     print("final sequence:", sequence)
+    if qualities:
+        print_qualities(transitions, event_qualities)
 
 if mode == "e4":
     """
@@ -177,4 +490,15 @@ if mode == "e4":
     posteriors[0][5] = 1.0 # stay
     posteriors[165][6] = 1.0 # AGGCA
     labels = [1, 0, 3, 11, 165, 0, 165]
-    find_path(posteriors, labels)
+    try:
+        find_path(
+            posteriors, labels, engine=engine, log_space=log_space,
+            compact=compact, top_k=top_k, floor=floor)
+    except ImpossibleTransitionError as error:
+        # only raised when decoding in log space
+        print(error)
+
+if mode is not None and instrumentation.enabled():
+    print(instrumentation.summary())
+    if args.metrics:
+        instrumentation.write_jsonl(args.metrics)
@@ -0,0 +1,301 @@
+"""
+transition structures shared by the decoders. For each transition function,
+k and number of states, the transitions which are allowed are found once by
+calling the transition function for every pair of states, and stored as a
+sparse matrix in compressed sparse row form, with a row for each state
+holding the states which can transition in to it. The lists and padded
+arrays used by the decoders are built from this matrix when first asked for.
+Structures are kept in memory for the most recently used transition
+functions, and can be saved to a directory as .npz files so that other
+processes, such as basecall_parallel workers, load them rather than
+building them again.
+"""
+import os
+from collections import OrderedDict
+import numpy as np
+import instrumentation
+
+# number of structures kept in memory, the least recently used is dropped
+# when another is built
+max_structures = 8
+
+_structures = OrderedDict()
+_cache_dir = None
+
+
+class TransitionStructure:
+    """
+    the allowed transitions between states, for one transition function,
+    k and number of states. State 0 is the stay state.
+    The transitions in to state st are those from indices[indptr[st]:
+    indptr[st+1]], with the transition integers in codes, in ascending order
+    of the state transitioned from. codes keep the type the transition
+    function returns, int64 for transition integers and float64 for
+    transition functions which return probabilities, such as the basic one.
+    """
+    def __init__(self, k, states, forbidden, from_stay, indptr, indices,
+                 codes):
+        """
+        :param k: k for kmer
+        :param states: number of states including the stay state
+        :param forbidden: value returned by the transition function for a
+        forbidden transition
+        :param from_stay: whether transitions from the stay state are allowed
+        :param indptr: start of each row in indices and codes
+        :param indices: states transitioned from
+        :param codes: transition integers or probabilities
+        :type k: int
+        :type states: int
+        :type forbidden: int
+        :type from_stay: bool
+        :type indptr: numpy array
+        :type indices: numpy array
+        :type codes: numpy array
+        """
+        self.k = k
+        self.states = states
+        self.forbidden = forbidden
+        self.from_stay = from_stay
+        self.indptr = indptr
+        self.indices = indices
+        self.codes = codes
+        self._table = None
+        self._dense_table = None
+        self._predecessor_arrays = None
+        self._successor_arrays = None
+
+    @classmethod
+    def build(cls, transition_func, k, states, forbidden, from_stay):
+        """
+        calls the transition function for every pair of states.
+        """
+        first = 0 if from_stay else 1
+        indptr = [0]
+        indices = []
+        codes = []
+        for st in range(states):
+            for prev_st in range(first, states):
+                trans_int = transition_func(prev_st, st, k=k)
+                if trans_int != forbidden:
+                    indices.append(prev_st)
+                    codes.append(trans_int)
+            indptr.append(len(indices))
+        # probabilities must not be truncated to integers
+        if all(isinstance(code, (int, np.integer)) for code in codes):
+            code_dtype = np.int64
+        else:
+            code_dtype = np.float64
+        return cls(
+            k, states, forbidden, from_stay,
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int64),
+            np.array(codes, dtype=code_dtype))
+
+    def save(self, path):
+        """
+        saves the structure as an .npz file. The file is written under
+        another name and then moved in to place, so that a process loading
+        it never sees it half written.
+        """
+        temp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+        np.savez(
+            temp_path, k=self.k, states=self.states,
+            forbidden=self.forbidden, from_stay=self.from_stay,
+            indptr=self.indptr, indices=self.indices, codes=self.codes)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads a structure saved by save.
+        """
+        with np.load(path) as saved:
+            return cls(
+                int(saved["k"]), int(saved["states"]),
+                int(saved["forbidden"]), bool(saved["from_stay"]),
+                saved["indptr"], saved["indices"], saved["codes"])
+
+    @property
+    def table(self):
+        """
+        list indexed by state where each element is a list of
+        (prev_st, trans_int) pairs in ascending order of prev_st.
+        Element 0 holds the stays.
+        """
+        if self._table is None:
+            indices = self.indices.tolist()
+            codes = self.codes.tolist()
+            self._table = [
+                list(zip(indices[start:end], codes[start:end]))
+                for start, end in zip(self.indptr[:-1].tolist(),
+                                      self.indptr[1:].tolist())]
+        return self._table
+
+    def predecessor_lists(self, trans_int):
+        """
+        for each state, the list of states which can transition in to it
+        with the transition integer trans_int, i.e. the step, skip or stay
+        predecessors.
+        """
+        return [[prev_st for prev_st, code in row if code == trans_int]
+                for row in self.table]
+
+    def dense(self):
+        """
+        the transition integer for every pair of states as a
+        (states, states) numpy array, indexed [st][prev_st]. Forbidden
+        transitions hold the forbidden value.
+        """
+        matrix = np.full(
+            (self.states, self.states), self.forbidden,
+            dtype=self.codes.dtype)
+        rows = np.repeat(np.arange(self.states), np.diff(self.indptr))
+        matrix[rows, self.indices] = self.codes
+        return matrix
+
+    @property
+    def dense_table(self):
+        """
+        dense as nested lists, for decoders which look at every pair of
+        states.
+        """
+        if self._dense_table is None:
+            self._dense_table = self.dense().tolist()
+        return self._dense_table
+
+    @property
+    def predecessor_arrays(self):
+        """
+        prev_states, prev_trans, stay_trans as padded numpy arrays.
+        prev_states[st-1] holds the states other than the stay state which
+        can transition in to st, padded with 0. prev_trans holds the
+        matching transition integers, padded with the forbidden value.
+        stay_trans[st-1] is the transition integer for st staying in st,
+        or the forbidden value if it cannot stay.
+        """
+        if self._predecessor_arrays is None:
+            states = self.states
+            sources = self.indices
+            dests = np.repeat(np.arange(states), np.diff(self.indptr))
+            stays = dests == 0
+            stay_trans = np.full(
+                states - 1, self.forbidden, dtype=self.codes.dtype)
+            from_kmer = sources[stays] > 0
+            stay_trans[sources[stays][from_kmer] - 1] = \
+                self.codes[stays][from_kmer]
+            kept = (dests > 0) & (sources > 0)
+            prev_states, prev_trans = _pad(
+                dests[kept] - 1, sources[kept], self.codes[kept],
+                states - 1, self.forbidden)
+            self._predecessor_arrays = prev_states, prev_trans, stay_trans
+        return self._predecessor_arrays
+
+    @property
+    def successor_arrays(self):
+        """
+        next_states, next_trans as padded numpy arrays. next_states[st-1]
+        holds the states other than the stay state which st can transition
+        in to, padded with 0. next_trans holds the matching transition
+        integers, padded with the forbidden value.
+        """
+        if self._successor_arrays is None:
+            sources = self.indices
+            dests = np.repeat(np.arange(self.states), np.diff(self.indptr))
+            kept = (dests > 0) & (sources > 0)
+            # a stable sort keeps the states transitioned in to in
+            # ascending order
+            order = np.argsort(sources[kept], kind="stable")
+            self._successor_arrays = _pad(
+                sources[kept][order] - 1, dests[kept][order],
+                self.codes[kept][order], self.states - 1, self.forbidden)
+        return self._successor_arrays
+
+
+def _pad(rows, values, codes, length, code_padding):
+    """
+    lays out values and codes, which are sorted by row, as arrays of
+    length rows padded with 0 and code_padding respectively.
+    """
+    counts = np.bincount(rows, minlength=length)
+    width = max(int(counts.max()), 1)
+    starts = np.cumsum(counts) - counts
+    columns = np.arange(len(rows)) - starts[rows]
+    padded_values = np.zeros((length, width), dtype=np.int64)
+    padded_codes = np.full((length, width), code_padding, dtype=codes.dtype)
+    padded_values[rows, columns] = values
+    padded_codes[rows, columns] = codes
+    return padded_values, padded_codes
+
+
+def transition_structure(transition_func, k=5, states=4**5 + 1,
+                         forbidden=-1, from_stay=False, cache_dir=None):
+    """
+    returns the TransitionStructure for a transition function, building it
+    only if it is not held in memory or saved in the cache directory.
+    :param transition_func: function which determines transition between
+    kmers
+    :param k: k for kmer
+    :param states: number of states including the stay state
+    :param forbidden: value returned by the transition function for a
+    forbidden transition, -1 for the stays transition and 0 for the basic one
+    :param from_stay: whether the stay state can be transitioned from
+    :param cache_dir: directory to load the structure from and save it in,
+    by default the one given to set_cache_dir. Files are named after the
+    module and name of the transition function, so should be deleted if
+    the function is changed.
+    :type transition_func: python function
+    :type k: int
+    :type states: int
+    :type forbidden: int
+    :type from_stay: bool
+    :type cache_dir: string
+    returns a TransitionStructure
+    """
+    key = (transition_func, k, states, forbidden, from_stay)
+    if key in _structures:
+        _structures.move_to_end(key)
+        return _structures[key]
+    if cache_dir is None:
+        cache_dir = _cache_dir
+    structure = None
+    with instrumentation.stage("transitions"):
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, _file_name(*key))
+            if os.path.exists(path):
+                structure = TransitionStructure.load(path)
+        if structure is None:
+            structure = TransitionStructure.build(*key)
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                structure.save(path)
+    _structures[key] = structure
+    while len(_structures) > max_structures:
+        _structures.popitem(last=False)
+    return structure
+
+
+def _file_name(transition_func, k, states, forbidden, from_stay):
+    """
+    name of the file a structure is saved in.
+    """
+    name = "{}.{}".format(
+        transition_func.__module__, transition_func.__qualname__)
+    name = "".join(c if c.isalnum() or c in "._" else "_" for c in name)
+    return "{}_k{}_s{}_f{}_{}.npz".format(
+        name, k, states, forbidden, int(from_stay))
+
+
+def set_cache_dir(path):
+    """
+    sets the directory transition structures are saved in and loaded from,
+    or None to only keep them in memory.
+    """
+    global _cache_dir
+    _cache_dir = path
+
+
+def clear():
+    """
+    drops every structure held in memory.
+    """
+    _structures.clear()
@@ -1,9 +1,54 @@
+import math
+import queue
+import threading
 import h5py
 import numpy as np
 import types
 import importlib.machinery
 import torch
 import torch.nn as nn
+import instrumentation
+
+
+class ImpossibleTransitionError(Exception):
+    """
+    raised when decoding in log space and every state of an event has
+    zero probability, i.e. there is an impossible transition in the
+    posteriors. Only the read being decoded is affected.
+    """
+    def __init__(self, event):
+        super().__init__(
+            "impossible transition in posteriors, around event {}".format(
+                event))
+        self.event = event
+
+
+def safe_log(prob):
+    """
+    natural log of a probability, returning -inf rather than raising
+    for a probability of zero.
+    """
+    if prob == 0:
+        return -math.inf
+    return math.log(prob)
+
+
+def as_posterior_array(posteriors):
+    """
+    returns posteriors as a numpy array, without copying them where
+    possible. Torch tensors, such as the output of get_posteriors, are
+    detached and only copied if they are not on the cpu. The layout is
+    unchanged, so the NCT output of the model stays (reads, states, events).
+    :param posteriors: posterior probabilities
+    :type posteriors: torch tensor / numpy array / list
+    :returns: numpy array
+    """
+    if isinstance(posteriors, torch.Tensor):
+        posteriors = posteriors.detach()
+        if posteriors.device.type != "cpu":
+            posteriors = posteriors.cpu()
+        return posteriors.numpy()
+    return np.asarray(posteriors)
 
 
 def number_to_kmer(number, k=5):
@@ -73,29 +118,241 @@ def kmer_to_number_nostay(kmer, k=5):
     return number_to_return
 
 
-def load_training_data(training_data_path, training_samples):
+# 2 bit code of each base, the order used by the kmer numbers
+BASES = "ACGT"
+# code given to every base of a stay by numbers_to_codes
+STAY_CODE = 255
+
+# the 2 bit code of each ascii character, 255 for those which are not bases
+_base_codes = np.full(128, 255, dtype=np.uint8)
+_base_codes[[ord(base) for base in BASES]] = np.arange(4)
+# the ascii character of each 2 bit code
+_base_letters = np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)
+
+_code_tables = {}
+_kmer_tables = {}
+
+
+def _code_table(k):
+    """
+    the 2 bit code of each base of every kmer, as a (4**k, k) uint8
+    array indexed by the kmer number without stays. Built once for each k.
+    """
+    if k not in _code_tables:
+        numbers = np.arange(4**k)
+        shifts = 2 * np.arange(k - 1, -1, -1)
+        _code_tables[k] = ((numbers[:, np.newaxis] >> shifts) & 3).astype(
+            np.uint8)
+    return _code_tables[k]
+
+
+def _kmer_table(k):
+    """
+    the string of every kmer as a numpy array indexed by the kmer number
+    with stays, i.e. element 0 is "stay". Built once for each k.
+    """
+    if k not in _kmer_tables:
+        letters = np.array(list(BASES))[_code_table(k)]
+        kmers = np.ascontiguousarray(letters).view("<U{}".format(k))[:, 0]
+        table = np.empty(4**k + 1, dtype="<U{}".format(max(k, 4)))
+        table[0] = "stay"
+        table[1:] = kmers
+        _kmer_tables[k] = table
+    return _kmer_tables[k]
+
+
+def numbers_to_kmers(numbers, k=5):
+    """
+    array version of number_to_kmer, converting every kmer number at once
+    using a lookup table. Stays (0) become "stay".
+    :param numbers: integer representations of kmers, such as a path from
+    determine_path
+    :param k: k for kmer
+    :type numbers: numpy array / list
+    :type k: int
+    returns numpy array of strings with the same shape as numbers
+    """
+    return _kmer_table(k)[np.asarray(numbers)]
+
+
+def numbers_to_kmers_nostay(numbers, k=5):
+    """
+    array version of number_to_kmer_nostay, where 0 is the kmer of all A.
+    :param numbers: integer representations of kmers without stays
+    :param k: k for kmer
+    :type numbers: numpy array / list
+    :type k: int
+    returns numpy array of strings with the same shape as numbers
+    """
+    return _kmer_table(k)[np.asarray(numbers) + 1]
+
+
+def kmers_to_numbers(kmers, k=5):
+    """
+    array version of kmer_to_number. "stay" becomes 0.
+    :param kmers: string representations of kmers
+    :param k: k for kmer
+    :type kmers: numpy array / list
+    :type k: int
+    returns numpy array of integers with the same shape as kmers
+    """
+    characters = _kmer_characters(kmers, max(k, 4))
+    stay = np.zeros(characters.shape[-1], dtype=np.uint32)
+    stay[:4] = [ord(letter) for letter in "stay"]
+    stays = (characters == stay).all(axis=-1)
+    codes = _base_codes[np.minimum(characters[..., :k], 127)]
+    codes[stays] = 0
+    if characters.shape[-1] > k:
+        # longer strings which are not stays
+        codes[(characters[..., k:] != 0).any(axis=-1) & ~stays] = 255
+    return np.where(stays, 0, codes_to_numbers_nostay(codes) + 1)
+
+
+def kmers_to_numbers_nostay(kmers, k=5):
+    """
+    array version of kmer_to_number_nostay.
+    :param kmers: string representations of kmers
+    :param k: k for kmer
+    :type kmers: numpy array / list
+    :type k: int
+    returns numpy array of integers with the same shape as kmers
+    """
+    characters = _kmer_characters(kmers, k)
+    return codes_to_numbers_nostay(_base_codes[np.minimum(characters, 127)])
+
+
+def _kmer_characters(kmers, length):
+    """
+    the unicode code point of each character of each kmer, with an extra
+    last axis of the given length. Shorter kmers are padded with 0.
+    """
+    kmers = np.asarray(kmers, dtype="<U{}".format(length))
+    return kmers.view(np.uint32).reshape(kmers.shape + (length,))
+
+
+def numbers_to_codes(numbers, k=5):
+    """
+    the 2 bit code of each base of every kmer number, where A is 0, C is 1,
+    G is 2 and T is 3. Every base of a stay (0) is given STAY_CODE.
+    :param numbers: integer representations of kmers
+    :param k: k for kmer
+    :type numbers: numpy array / list
+    :type k: int
+    returns uint8 numpy array with an extra last axis of length k
+    """
+    numbers = np.asarray(numbers)
+    codes = numbers_to_codes_nostay(np.maximum(numbers - 1, 0), k=k)
+    codes[numbers == 0] = STAY_CODE
+    return codes
+
+
+def numbers_to_codes_nostay(numbers, k=5):
+    """
+    as numbers_to_codes, for kmer numbers without stays.
+    """
+    return _code_table(k)[np.asarray(numbers)]
+
+
+def codes_to_bases(codes):
+    """
+    the string of bases for an array of 2 bit codes.
+    :param codes: 2 bit codes of each base
+    :type codes: numpy array
+    returns string
+    """
+    return _base_letters[np.asarray(codes)].tobytes().decode("ascii")
+
+
+def codes_to_numbers(codes):
+    """
+    the kmer number of the 2 bit codes along the last axis, the reverse of
+    numbers_to_codes. Kmers whose codes hold STAY_CODE become stays (0).
+    :param codes: 2 bit codes of each base
+    :type codes: numpy array
+    returns numpy array of integers
+    """
+    codes = np.asarray(codes)
+    stays = (codes == STAY_CODE).any(axis=-1)
+    numbers = codes_to_numbers_nostay(np.where(codes == STAY_CODE, 0, codes))
+    return np.where(stays, 0, numbers + 1)
+
+
+def codes_to_numbers_nostay(codes):
+    """
+    as codes_to_numbers, for kmer numbers without stays.
+    Raises ValueError if a code is not a base.
+    """
+    codes = np.asarray(codes)
+    if (codes > 3).any():
+        raise ValueError("kmers may only contain the bases " + BASES)
+    k = codes.shape[-1]
+    shifts = 2 * np.arange(k - 1, -1, -1)
+    return (codes.astype(np.int64) << shifts).sum(axis=-1)
+
+
+def load_training_data(training_data_path, training_samples,
+                       return_indices=False):
     """
     loads training data from a hdf5 file and returns
-    data and labels as two different arrays
+    data and labels as two different arrays. Only the randomly selected
+    rows are read from the file.
     :param training_data_path: path to data
     :param training_samples: number of samples to load. i.e.
     how many reads of length 8000 to load
+    :param return_indices: also return the row of each sample in the file,
+    e.g. to look its posteriors up in a PosteriorCache
     :type training_data_path: string
     :type training_samples: int
-    :returns array of training data, array of labels
+    :type return_indices: bool
+    :returns array of training data, array of labels, and the array of
+    rows if return_indices is set
     """
     with h5py.File(training_data_path, 'r') as h5:
-        num_chunks = len(h5['chunks'][:])
+        num_chunks = h5['chunks'].shape[0]
         print(
             "Selecting {} out of {} chunks".format(
                 training_samples, num_chunks))
         random_selection = np.random.choice(
             num_chunks, training_samples, replace=False)
-        training_chunks = h5['chunks'][:][random_selection]
-        training_labels = h5['labels'][:][random_selection]
+        # h5py can only read rows in increasing order, so read them sorted
+        # then put them back in the random order
+        order = np.argsort(random_selection)
+        unsort = np.empty_like(order)
+        unsort[order] = np.arange(len(order))
+        sorted_selection = random_selection[order]
+        training_chunks = h5['chunks'][sorted_selection][unsort]
+        training_labels = h5['labels'][sorted_selection][unsort]
+    if return_indices:
+        return training_chunks, training_labels, random_selection
     return training_chunks, training_labels
 
 
+def iter_training_data(training_data_path, batch_size, start=0, stop=None):
+    """
+    streams training data from a hdf5 file in batches of consecutive rows,
+    so that only one batch is in memory at a time.
+    :param training_data_path: path to data
+    :param batch_size: number of rows in each batch. The last batch may
+    be smaller.
+    :param start: first row to read
+    :param stop: row to stop before, by default the end of the file
+    :type training_data_path: string
+    :type batch_size: int
+    :type start: int
+    :type stop: int
+    :yields array of training data, array of labels
+    """
+    with h5py.File(training_data_path, 'r') as h5:
+        chunks = h5['chunks']
+        labels = h5['labels']
+        if stop is None:
+            stop = chunks.shape[0]
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            yield (chunks[batch_start:batch_stop],
+                   labels[batch_start:batch_stop])
+
+
 def get_posteriors(data, model_class_path, model_path, sample_grouping=5):
     """
     gets the posterior probabilities from a trained neural network model
@@ -110,16 +367,112 @@ def get_posteriors(data, model_class_path, model_path, sample_grouping=5):
     :type sample_grouping:int
     :returns: posterior probabilities for each event for each kmer
     """
-    loader = importlib.machinery.SourceFileLoader('Model', model_class_path)
-    module = types.ModuleType(loader.name)
-    loader.exec_module(module)
-    model = module.Model(sample_grouping)
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model.to(device)
-    model.load_state_dict(torch.load(model_path))
-    data = torch.from_numpy(data).to(device)
-    data = data.permute(0, 2, 1)
-    output = model(data)
-    m = nn.Softmax(dim=1)
-    normalised_output = m(output)
+    model, device = load_model(model_class_path, model_path, sample_grouping)
+    with instrumentation.stage("inference", reads=len(data), device=device):
+        data = torch.from_numpy(data).to(device)
+        data = data.permute(0, 2, 1)
+        output = model(data)
+    with instrumentation.stage("softmax", reads=len(data), device=device):
+        m = nn.Softmax(dim=1)
+        normalised_output = m(output)
     return normalised_output
+
+
+def load_model(model_class_path, model_path, sample_grouping=5):
+    """
+    loads a trained model, only reading the model class and weights the
+    first time they are asked for in this process.
+    :param model_class_path: path to model class
+    :param model_path: path pickle of train model
+    :param sample_grouping: the number of samples which will get
+    classifed in to one kmer
+    :type model_class_path: string
+    :type model_path: string
+    :type sample_grouping:int
+    :returns: the model and the device it is on
+    """
+    key = (model_class_path, model_path, sample_grouping)
+    if key not in _models:
+        with instrumentation.stage("model_load"):
+            loader = importlib.machinery.SourceFileLoader(
+                'Model', model_class_path)
+            module = types.ModuleType(loader.name)
+            loader.exec_module(module)
+            model = module.Model(sample_grouping)
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            model.to(device)
+            model.load_state_dict(torch.load(model_path))
+        _models[key] = model, device
+    return _models[key]
+
+
+_models = {}
+
+
+class PosteriorProvider:
+    """
+    produces posteriors from a cached model in mini batches. Inference runs
+    on a background thread, so the caller can decode one batch while the
+    next is going through the network.
+    """
+    def __init__(self, model_class_path, model_path, sample_grouping=5,
+                 batch_size=8, prefetch=2):
+        """
+        :param model_class_path: path to model class
+        :param model_path: path pickle of train model
+        :param sample_grouping: the number of samples which will get
+        classifed in to one kmer
+        :param batch_size: number of reads put through the model at a time
+        :param prefetch: number of batches inferred ahead of the caller
+        :type model_class_path: string
+        :type model_path: string
+        :type sample_grouping: int
+        :type batch_size: int
+        :type prefetch: int
+        """
+        self.model, self.device = load_model(
+            model_class_path, model_path, sample_grouping)
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+
+    def posteriors(self, data):
+        """
+        posteriors for one batch of data in form NHC, as a numpy array in
+        the form (reads, states, events).
+        """
+        reads = len(data)
+        with torch.no_grad():
+            with instrumentation.stage(
+                    "inference", reads=reads, device=self.device):
+                data = torch.from_numpy(data).to(self.device)
+                output = self.model(data.permute(0, 2, 1))
+            with instrumentation.stage(
+                    "softmax", reads=reads, device=self.device):
+                return torch.softmax(output, dim=1).cpu().numpy()
+
+    def iter_posteriors(self, data):
+        """
+        yields the posteriors for data in form NHC, batch_size reads at a
+        time, while later batches are inferred on a background thread.
+        """
+        batches = queue.Queue(maxsize=self.prefetch)
+
+        def infer():
+            try:
+                for start in range(0, len(data), self.batch_size):
+                    batches.put(
+                        self.posteriors(data[start:start + self.batch_size]))
+            except Exception as error:
+                batches.put(error)
+            batches.put(None)
+
+        thread = threading.Thread(target=infer, daemon=True)
+        thread.start()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        thread.join()
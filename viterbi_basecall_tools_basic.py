@@ -3,9 +3,14 @@ Viterbi algorithm for basecalling compatible with different kmers
 The algorythm does not account for stays. i.e. will classify stays in the
 same way as any other state.
 """
+import math
+import operator
+import numpy as np
+from utils import ImpossibleTransitionError, safe_log
+from transition_cache import transition_structure
 
 
-def viterbi(posterior, transition_func, k=5, norm_interval=4):
+def viterbi(posterior, transition_func, k=5, norm_interval=4, log_space=False):
     """
     input 2d posterior probabilities i.e. (1025, 1600) and the transition
     function which determines the transition probability between two kmers.
@@ -17,15 +22,35 @@ def viterbi(posterior, transition_func, k=5, norm_interval=4):
     :param norm_interval: after a certain number of events, the dynamic
 
     between kmers
+    :param log_space: work with log probabilities instead. No normalisation
+    is needed, and an event where every state is impossible raises
+    ImpossibleTransitionError.
     :type posterior: numpy array / list
     :type transition_func: python function
     :type k: int
     :type norm_interval: int
+    :type log_space: bool
    returns dynamic programming table, backtrace table
     """
     states = len(posterior)
     events = len(posterior[0])
-    V = [[0 for i in range(events)] for j in range(states)]
+    if log_space:
+        zero = -math.inf
+        combine = operator.add
+        posterior = [[safe_log(prob) for prob in row] for row in posterior]
+    else:
+        zero = 0
+        combine = operator.mul
+    # a transition of 0 is forbidden, and any state can be transitioned from
+    table = transition_structure(
+        transition_func, k=k, states=states, forbidden=0,
+        from_stay=True).table
+    if log_space:
+        # take the log of each transition probability once, rather than on
+        # every event
+        table = [[(prev_st, safe_log(trans)) for prev_st, trans in row]
+                 for row in table]
+    V = [[zero for i in range(events)] for j in range(states)]
     B = [[0 for i in range(events)] for j in range(states)]
     for st in range(states):
         # initialise first "day" of dp table
@@ -42,24 +67,25 @@ def viterbi(posterior, transition_func, k=5, norm_interval=4):
             # (i.e. A C G T )
             # see for this "day" which path has maximum probability
             # for that state
-            max_prob = 0
+            max_prob = zero
             prev_st_save = 0
-            for prev_st in range(states):
+            # only the transitions which are not forbidden, in ascending
+            # order of prev_st
+            for prev_st, trans in table[st]:
                 # find the correct st and prob to save in to the dpgraph
-                trans = transition_func(prev_st, st, k=k)
-                if trans != 0:
-                    prob = V[prev_st][t-1]*trans
-                    if prob > max_prob:
-                        max_prob = prob
-                        prev_st_save = prev_st
-                else:
-                    pass
+                prob = combine(V[prev_st][t-1], trans)
+                if prob > max_prob:
+                    max_prob = prob
+                    prev_st_save = prev_st
 
-            max_prob_until = max_prob * posterior[st][t]
+            max_prob_until = combine(max_prob, posterior[st][t])
             V[st][t] = max_prob_until
             B[st][t] = prev_st_save
 
-        if t % norm_interval == 0:
+        if log_space:
+            if all(V[i][t] == zero for i in range(states)):
+                raise ImpossibleTransitionError(t)
+        elif t % norm_interval == 0:
             sum = 0
             for i in range(states-1):
 
@@ -73,7 +99,9 @@ def viterbi(posterior, transition_func, k=5, norm_interval=4):
 def determine_path(V, B):
     """
     given a dynamic programming table and a backtrace table, returns
-    the most likely path using the viterbi algoithm.
+    the most likely path using the viterbi algoithm. The path is traced
+    back from the most likely last state, filling a preallocated array from
+    the end.
     :param V: dynamic programming table.
     :param B: backtrace table
     :type V: 2d list
@@ -81,19 +109,18 @@ def determine_path(V, B):
     returns most likely path of kmers
     """
     events = len(B[0])
-    last_prob = [V[i][-1] for i in range(len(V))]
-    # list of final values of probabilities
-    kmer_max_prob = last_prob.index(max(last_prob))
-    likely_path = [kmer_max_prob]
+    # final values of probabilities, only the last column of V is read
+    last_prob = np.array([V[i][-1] for i in range(len(V))])
+    path = np.empty(events, dtype=np.int64)
     # index of the maximum probability i.e. if
     # kmer_max_prob = 1 > AAA was last base in path
     # this is G. ie. 2.
-    for t in range(1, events):
-        kmer_of_interest = B[kmer_max_prob]
-        previous_kmer = kmer_of_interest[-1*t]
-        likely_path.insert(0, previous_kmer)
-        kmer_max_prob = previous_kmer
-    return likely_path
+    kmer = int(np.argmax(last_prob))
+    path[events - 1] = kmer
+    for t in range(events - 1, 0, -1):
+        kmer = int(B[kmer][t])
+        path[t - 1] = kmer
+    return path.tolist()
 
 
 def transition(first, second, k=5):
@@ -7,7 +7,16 @@ table. The first row of the backtrace table indicates the branch which
 started with AAAAA. i.e. there are no stay states in the backtrace table.
 """
 import sys
-from utils import number_to_kmer_nostay
+import math
+import time
+import operator
+import numpy as np
+from utils import ImpossibleTransitionError, safe_log
+from utils import numbers_to_codes, codes_to_bases
+from utils import as_posterior_array
+from transition_cache import transition_structure
+import instrumentation
+import numba_kernels
 
 # the transition function outputs integers depending on whether the output
 # is not allowed, stay, skip or step. These are translated in to probabilities
@@ -15,9 +24,20 @@ from utils import number_to_kmer_nostay
 
 transition_dict = {-1: 0, 0: 0.01, 1: 0.01, 2: 0.1}
 
+# values marking empty slots in compact backtrace and transitions tables
+EMPTY_STATE = 0
+EMPTY_TRANSITION = -1
+# log probability below the most likely state at which viterbi_sparse_posterior
+# stops carrying a state on to the next event
+SPARSE_BEAM_THRESHOLD = 20.0
+
+# highest Phred quality given by path_qualities, an error probability of
+# one in a million
+MAX_QUALITY = 60
+
 
 def viterbi(posterior, transition_func, transition_dict=transition_dict,
-            k=5, norm_interval=4):
+            k=5, norm_interval=4, log_space=False, compact=False):
     """
     input 2d posterior probabilities i.e. (1025, 1600) and the transition
     function which determines the transition probability between two kmers.
@@ -31,55 +51,74 @@ def viterbi(posterior, transition_func, transition_dict=transition_dict,
     :param k: k for kmer
     :param norm_interval: after a certain number of events, the dynamic
     programming table will be normalised.
-    :type posterior: numpy array / list
+    :param log_space: work with log probabilities instead. No normalisation
+    is needed, and an event where every state is impossible raises
+    ImpossibleTransitionError rather than exiting.
+    :param compact: store the backtrace and transitions tables as typed numpy
+    arrays, and only keep the last two columns of the dynamic programming
+    table. See _allocate_tables.
+    :type posterior: numpy array / torch tensor / list
     :type transition_func: python function
     :type transition_dict: dictionary
     :type k: int
     :type norm_interval: int
+    :type log_space: bool
+    :type compact: bool
     returns dynamic programming table, backtrace table and transitions table.
     N.B. the first row of the backtrace table will represent the branch which
     started with the AAAAA kmer, and the value of 1 in the backtrace table will
     represent the first kmer, i.e. AAAAA. Stays are not considered a state,
     and therefore there will be no zeros in the table. Empty slots on the table
-    will be indicated by None to minimise confusion with stays.
+    will be indicated by None to minimise confusion with stays, or by
+    EMPTY_STATE and EMPTY_TRANSITION in compact tables.
     Each element of the transition table shows the transition needed to
     transition in to that state. Neccessary for stringing together kmers. i.e.
     T[1][2] will indicate the transition needed to get to the state b[1][2].
     """
     states = len(posterior)
     events = len(posterior[0])
-    V = [[0 for i in range(events)] for j in range(states - 1)]
-    B = [[None for i in range(events-1)] for j in range(states - 1)]
-    T = [[None for i in range(events-1)] for j in range(states - 1)]
-    for st in range(1, states):
-        # initialise first "day" of dp table
-        V[st-1][0] = posterior[st][0]
-        # posterior[0] : all the probabilities for A for three days
-        # posterior[0][0]: probability for A for day 1.
-        # V[0]: results for day 1
-        # V[0][0] results for day 1 base 1
+    zero, combine, trans_probs = _probability_space(
+        transition_dict, log_space)
+    V, B, T = _allocate_tables(states, events, zero, compact)
+    # the transition integer of every pair of states, from the transition
+    # structure cache rather than calling transition_func on every event
+    trans_ints = transition_structure(
+        transition_func, k=k, states=states).dense_table
+    # the posteriors are read one column at a time, and the previous and
+    # current columns of the dynamic programming table are worked on as
+    # lists, then stored in V
+    columns = _posterior_columns(posterior, log_space)
+    # initialise first "day" of dp table
+    # posterior[0] : all the probabilities for A for three days
+    # posterior[0][0]: probability for A for day 1.
+    column = next(columns)
+    prev = column[1:]
+    _store_column(V, prev, 0, compact)
     for t in range(1, events):
         # for each "day"
+        column = next(columns)
+        cur = [zero for i in range(states - 1)]
         # st is the state we are transitioning in to
         for st in range(states):
+            st_trans_ints = trans_ints[st]
             # look at a single branch of probabilities out of states.
             # (i.e. A C G T )
             # see for this "day" which path has maximum probability
             # for that state
-            max_prob = 0
+            max_prob = zero
             prev_st_save = 0
             trans_save = None
             # prev_st is the transition we are transitioning from
             # cannot transition from a stay state therefore start at 1
             for prev_st in range(1, states):
                 # find the correct st and prob to save in to the dpgraph
-                trans_int = transition_func(prev_st, st, k=k)
-                trans = transition_dict[trans_int]
-                if trans != 0:
+                trans_int = st_trans_ints[prev_st]
+                trans = trans_probs[trans_int]
+                if trans != zero:
                     # note the first row of posterior represents stays
                     # the first row of B and V represents AA.
                     # hence [prev_st -1] when indexing V.
-                    prob = V[prev_st-1][t-1] * trans
+                    prob = combine(prev[prev_st-1], trans)
                     if prob > max_prob:
                         max_prob = prob
                         prev_st_save = prev_st
@@ -95,40 +134,1254 @@ def viterbi(posterior, transition_func, transition_dict=transition_dict,
                     # V[st] but for stay we can update V[prev_st]
                     # repeat for all prev_st
                     if st == 0:
-                        prob = prob * posterior[st][t]
-                        V[prev_st-1][t] = prob
-                        if prob != 0 and t < (events):
+                        prob = combine(prob, column[st])
+                        cur[prev_st-1] = prob
+                        if prob != zero and t < (events):
                             B[prev_st-1][t-1] = prev_st
                             T[prev_st-1][t-1] = trans_int
                 else:
                     pass
             if st != 0:
-                max_prob_until = max_prob * posterior[st][t]
+                max_prob_until = combine(max_prob, column[st])
                 # if the non stay state transition probability is
                 # larger than the stay state i.e.
                 # GA --> AA is greater than
                 # GA --> AA (stay)
                 # then replace V[st -1][t] with the non stay probability
-                if max_prob_until > V[st - 1][t]:
-                    V[st - 1][t] = max_prob_until
+                if max_prob_until > cur[st - 1]:
+                    cur[st - 1] = max_prob_until
                     if t < (events):
                         B[st - 1][t-1] = prev_st_save
                         T[st-1][t-1] = trans_save
 
-        if t % norm_interval == 0:
-            sum_is = 0.0
-            for i in range(states-1):
-                sum_is += V[i][t]
-            try:
-                for i in range(states-1):
-                    V[i][t] = (V[i][t])/sum_is
-            except ZeroDivisionError:
-                print(
-                    "impossible transition in posteriors or underflow, around event", t)
-                sys.exit(1)
+        if log_space:
+            _check_column(cur, t)
+        elif t % norm_interval == 0:
+            _normalise_column(cur, t)
+        _store_column(V, cur, t, compact)
+        prev = cur
+    return V, B, T
+
+
+def _probability_space(transition_dict, log_space):
+    """
+    returns the probability of an impossible path, the function which
+    combines two probabilities and the transition dictionary to decode with,
+    either as given or as log probabilities.
+    """
+    if log_space:
+        trans_probs = {
+            trans_int: safe_log(prob)
+            for trans_int, prob in transition_dict.items()}
+        return -math.inf, operator.add, trans_probs
+    return 0, operator.mul, transition_dict
+
+
+def _posterior_columns(posterior, log_space):
+    """
+    yields each event of the posteriors as a list of python floats, or of
+    their logs, so that the decoding loops never index tensors or arrays
+    one element at a time.
+    """
+    posterior = _as_posteriors(posterior)
+    for t in range(posterior.shape[1]):
+        if hasattr(posterior, "log_column"):
+            column = posterior.log_column(t)
+            if not log_space:
+                column = np.exp(column)
+            yield column.tolist()
+            continue
+        column = posterior[:, t].tolist()
+        if log_space:
+            column = [safe_log(prob) for prob in column]
+        yield column
+
+
+def _as_posteriors(posteriors):
+    """
+    posteriors as a numpy array, see as_posterior_array. Compact formats
+    such as posterior_formats.QuantizedPosteriors, which give the log
+    probabilities of one event at a time through log_column, are left as
+    they are.
+    """
+    if hasattr(posteriors, "log_column"):
+        return posteriors
+    return as_posterior_array(posteriors)
+
+
+def state_dtype(states):
+    """
+    smallest unsigned integer type which can hold every state number,
+    uint16 for 5mers.
+    """
+    if states <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.uint32
+
+
+def _allocate_tables(states, events, zero, compact):
+    """
+    allocates the dynamic programming, backtrace and transitions tables.
+    By default these are lists of lists with None in empty slots. With
+    compact, the backtrace and transitions tables are numpy arrays of
+    state_dtype and int8 with EMPTY_STATE and EMPTY_TRANSITION in empty
+    slots, and the dynamic programming table only holds the previous and
+    current columns.
+    """
+    if compact:
+        V = np.full((states - 1, 2), zero, dtype=np.float64)
+        B = np.full(
+            (states - 1, events - 1), EMPTY_STATE, dtype=state_dtype(states))
+        T = np.full((states - 1, events - 1), EMPTY_TRANSITION, dtype=np.int8)
+    else:
+        V = [[zero for i in range(events)] for j in range(states - 1)]
+        B = [[None for i in range(events-1)] for j in range(states - 1)]
+        T = [[None for i in range(events-1)] for j in range(states - 1)]
     return V, B, T
 
 
+def _store_column(V, column, t, compact):
+    """
+    stores column t of the dynamic programming table. A compact table keeps
+    the column before it in V[:, 0] and the latest column in V[:, -1].
+    """
+    if compact:
+        V[:, 0] = V[:, 1]
+        V[:, 1] = column
+    else:
+        for i in range(len(column)):
+            V[i][t] = column[i]
+
+
+def _normalise_column(column, t):
+    """
+    normalises column t of the dynamic programming table in place so that
+    it sums to one. Exits if the column is all zeros.
+    """
+    sum_is = 0.0
+    for i in range(len(column)):
+        sum_is += column[i]
+    try:
+        for i in range(len(column)):
+            column[i] = (column[i])/sum_is
+    except ZeroDivisionError:
+        print("impossible transition in posteriors or underflow, "
+              "around event", t)
+        sys.exit(1)
+
+
+def _check_column(column, t):
+    """
+    raises ImpossibleTransitionError if every state in column t of a log
+    space dynamic programming table is impossible.
+    """
+    if all(prob == -math.inf for prob in column):
+        raise ImpossibleTransitionError(t)
+
+
+def predecessor_table(transition_func, k=5, states=4**5 + 1):
+    """
+    the list of states which can transition in to each state, taken from the
+    transition structure cache.
+    For a 5mer a state can only be reached from 4 step predecessors,
+    16 skip predecessors and itself, so scoring only these edges avoids
+    calling the transition function for every pair of states on every event.
+    :param transition_func: function which determines transition between
+    kmers
+    :param k: k for kmer
+    :param states: number of states including the stay state
+    :type transition_func: python function
+    :type k: int
+    :type states: int
+    returns a list indexed by state where each element is a list of
+    (prev_st, trans_int) pairs in ascending order of prev_st. Forbidden
+    transitions (-1) are left out. Element 0 holds the stay transitions.
+    """
+    return transition_structure(transition_func, k=k, states=states).table
+
+
+def viterbi_sparse(posterior, transition_func, transition_dict=transition_dict,
+                   k=5, norm_interval=4, log_space=False, compact=False):
+    """
+    same as viterbi, but only scores the transitions found in the
+    predecessor table rather than every pair of states. Produces the same
+    dynamic programming table, backtrace table and transitions table, with
+    empty slots as None, or EMPTY_STATE and EMPTY_TRANSITION in compact
+    tables.
+    :param posterior: posterior probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param norm_interval: after a certain number of events, the dynamic
+    programming table will be normalised.
+    :param log_space: work with log probabilities instead. No normalisation
+    is needed, and an event where every state is impossible raises
+    ImpossibleTransitionError rather than exiting.
+    :param compact: store the backtrace and transitions tables as typed numpy
+    arrays, and only keep the last two columns of the dynamic programming
+    table. See _allocate_tables.
+    :type posterior: numpy array / torch tensor / list
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type norm_interval: int
+    :type log_space: bool
+    :type compact: bool
+    returns dynamic programming table, backtrace table and transitions table.
+    """
+    states = len(posterior)
+    events = len(posterior[0])
+    table = predecessor_table(transition_func, k=k, states=states)
+    zero, combine, trans_probs = _probability_space(
+        transition_dict, log_space)
+    V, B, T = _allocate_tables(states, events, zero, compact)
+    columns = _posterior_columns(posterior, log_space)
+    prev = next(columns)[1:]
+    _store_column(V, prev, 0, compact)
+    for t in range(1, events):
+        column = next(columns)
+        cur = [zero for i in range(states - 1)]
+        # stays first, these are overwritten below if a step or skip
+        # in to the same state is more likely
+        for prev_st, trans_int in table[0]:
+            trans = trans_probs[trans_int]
+            if trans != zero:
+                prob = combine(combine(prev[prev_st-1], trans), column[0])
+                cur[prev_st-1] = prob
+                if prob != zero:
+                    B[prev_st-1][t-1] = prev_st
+                    T[prev_st-1][t-1] = trans_int
+        for st in range(1, states):
+            max_prob = zero
+            prev_st_save = 0
+            trans_save = None
+            for prev_st, trans_int in table[st]:
+                trans = trans_probs[trans_int]
+                if trans != zero:
+                    prob = combine(prev[prev_st-1], trans)
+                    if prob > max_prob:
+                        max_prob = prob
+                        prev_st_save = prev_st
+                        trans_save = trans_int
+            max_prob_until = combine(max_prob, column[st])
+            if max_prob_until > cur[st - 1]:
+                cur[st - 1] = max_prob_until
+                B[st - 1][t-1] = prev_st_save
+                T[st-1][t-1] = trans_save
+
+        if log_space:
+            _check_column(cur, t)
+        elif t % norm_interval == 0:
+            _normalise_column(cur, t)
+        _store_column(V, cur, t, compact)
+        prev = cur
+    return V, B, T
+
+
+def predecessor_arrays(transition_func, k=5, states=4**5 + 1):
+    """
+    the predecessor table as padded numpy arrays, for decoders which score
+    all states of an event at once.
+    :param transition_func: function which determines transition between
+    kmers
+    :param k: k for kmer
+    :param states: number of states including the stay state
+    :type transition_func: python function
+    :type k: int
+    :type states: int
+    returns prev_states, prev_trans, stay_trans.
+    prev_states[st-1] holds the states which can step or skip in to st,
+    padded with 0. prev_trans holds the matching transition integers,
+    padded with -1. stay_trans[st-1] is the transition integer for
+    st staying in st, or -1 if it cannot stay.
+    """
+    return transition_structure(
+        transition_func, k=k, states=states).predecessor_arrays
+
+
+def _log_transitions(trans_ints, transition_dict):
+    """
+    maps an array of transition integers to log probabilities using the
+    transition dictionary. -1 padding and zero probabilities become -inf.
+    """
+    probs = np.zeros(trans_ints.shape)
+    for trans_int, prob in transition_dict.items():
+        probs[trans_ints == trans_int] = prob
+    probs[trans_ints == -1] = 0
+    with np.errstate(divide="ignore"):
+        return np.log(probs)
+
+
+def viterbi_numpy(posterior, transition_func, transition_dict=transition_dict,
+                  k=5):
+    """
+    vectorised version of viterbi which works in log space. Each event is
+    updated for all states at once using the predecessor arrays, so no
+    normalisation is needed.
+    :param posterior: posterior probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :type posterior: numpy array / torch tensor / list
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    returns dynamic programming table of log probabilities, backtrace table
+    and transitions table as numpy arrays in the compact form described in
+    _allocate_tables. Raises ImpossibleTransitionError if every state of an
+    event is impossible.
+    """
+    posterior = _as_posteriors(posterior)
+    V, B, T = viterbi_batch(
+        posterior[np.newaxis], transition_func,
+        transition_dict=transition_dict, k=k)
+    _check_batch_read(V[0], B[0])
+    return V[0], B[0], T[0]
+
+
+def viterbi_numba(posterior, transition_func, transition_dict=transition_dict,
+                  k=5):
+    """
+    viterbi_numpy with the update of each event compiled by numba, see
+    numba_kernels. Each state is updated in a loop rather than through
+    temporary arrays. Falls back to viterbi_numpy when numba is not
+    installed. The tables are the same as viterbi_numpy's.
+    :param posterior: posterior probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :type posterior: numpy array / torch tensor / list
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    returns dynamic programming table of log probabilities, backtrace table
+    and transitions table as numpy arrays in the compact form described in
+    _allocate_tables. Raises ImpossibleTransitionError if every state of an
+    event is impossible.
+    """
+    if not numba_kernels.available:
+        return viterbi_numpy(
+            posterior, transition_func, transition_dict=transition_dict, k=k)
+    posterior = _as_posteriors(posterior)[np.newaxis]
+    states, events = posterior.shape[1:]
+    arrays = _step_arrays(transition_func, transition_dict, k, states)
+    # stored with events first, as in viterbi_batch, so each event's
+    # columns are contiguous
+    B = np.full(
+        (events - 1, states - 1), EMPTY_STATE, dtype=state_dtype(states))
+    T = np.full((events - 1, states - 1), EMPTY_TRANSITION, dtype=np.int8)
+    V = np.full((2, states - 1), -np.inf)
+    V[1] = _log_column(posterior, 0)[0, 1:]
+    for t in range(1, events):
+        V[0] = V[1]
+        numba_kernels.viterbi_step(
+            V[0], _log_column(posterior, t)[0], *arrays, V[1], B[t-1],
+            T[t-1], EMPTY_STATE, EMPTY_TRANSITION)
+    _check_batch_read(V.T, B.T)
+    return V.T, B.T, T.T
+
+
+def viterbi_batch(posteriors, transition_func, transition_dict=transition_dict,
+                  k=5, forward=False):
+    """
+    runs viterbi_numpy over a batch of reads at once. All reads share the
+    predecessor arrays and must have the same number of events.
+    With forward, the forward recursion is run in the same pass, summing
+    over the paths in to each state rather than taking the most likely,
+    for path_qualities.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events), as returned by get_posteriors
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :type posteriors: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :param forward: whether to run the forward recursion as well
+    :type forward: bool
+    returns compact dynamic programming, backtrace and transitions tables
+    with a leading read axis, i.e. V[n] is the table for read n. Reads with an
+    impossible transition are not checked here, see decode_batch.
+    With forward, also the forward table F as float32 of
+    (reads, states-1, events) and scales as float64 of (reads, events),
+    where the forward probability of kmer st at event t is
+    F[n, st-1, t] * exp(scales[n, t]). Each column is scaled so its largest
+    value is 1, so the probabilities neither underflow nor lose precision
+    for the likely states.
+    """
+    posteriors = _as_posteriors(posteriors)
+    reads, states, events = posteriors.shape
+    arrays = _step_arrays(transition_func, transition_dict, k, states)
+    # the backtrace and transitions tables are filled one event at a time,
+    # so they are stored with events first and returned as
+    # (reads, states, events) views
+    B = np.full(
+        (events - 1, reads, states - 1), EMPTY_STATE,
+        dtype=state_dtype(states))
+    T = np.full(
+        (events - 1, reads, states - 1), EMPTY_TRANSITION, dtype=np.int8)
+    # only the previous and current columns of the dynamic programming
+    # table are kept
+    V = np.full((2, reads, states - 1), -np.inf)
+    V[1] = _log_column(posteriors, 0)[:, 1:]
+    if forward:
+        F = np.empty((events, reads, states - 1), dtype=np.float32)
+        scales = np.empty((events, reads))
+        sum_arrays = _sum_arrays(arrays)
+        alpha, scale = _rescale(np.exp(V[1]))
+        F[0] = alpha
+        scales[0] = scale
+    for t in range(1, events):
+        log_posterior = _log_column(posteriors, t)
+        V[0] = V[1]
+        V[1], B[t-1], T[t-1] = _viterbi_step(V[0], log_posterior, arrays)
+        if forward:
+            alpha, scale = _rescale(_forward_step(
+                alpha, np.exp(log_posterior), sum_arrays))
+            F[t] = alpha
+            scales[t] = scales[t-1] + scale
+    tables = (
+        V.transpose(1, 2, 0), B.transpose(1, 2, 0), T.transpose(1, 2, 0))
+    if forward:
+        return tables + (F.transpose(1, 2, 0), scales.T)
+    return tables
+
+
+def _step_arrays(transition_func, transition_dict, k, states):
+    """
+    the predecessor arrays along with their log transition probabilities,
+    as used by _viterbi_step.
+    """
+    prev_states, prev_trans, stay_trans = predecessor_arrays(
+        transition_func, k=k, states=states)
+    return (prev_states, prev_trans, stay_trans,
+            _log_transitions(prev_trans, transition_dict),
+            _log_transitions(stay_trans, transition_dict))
+
+
+def _log_column(posteriors, t):
+    """
+    log posterior probabilities of every state at event t, in the form
+    (reads, states). Only this column is converted to float64, so the
+    posteriors can be kept in the dtype the model produced, or in a compact
+    format from posterior_formats.
+    """
+    if hasattr(posteriors, "log_column"):
+        return posteriors.log_column(t)
+    with np.errstate(divide="ignore"):
+        return np.log(posteriors[:, :, t], dtype=np.float64)
+
+
+def _viterbi_step(V_prev, log_posterior, arrays, rows=None):
+    """
+    advances a batch of reads by one event.
+    :param V_prev: log probabilities of the previous event, (reads, states-1)
+    :param log_posterior: log posteriors of this event, (reads, states)
+    :param arrays: arrays from _step_arrays
+    :param rows: rows of the table to update, i.e. state numbers - 1.
+    All rows by default.
+    returns the new column of the dynamic programming table, and the
+    columns of the backtrace and transitions tables for this event,
+    holding only the rows asked for.
+    """
+    prev_states, prev_trans, stay_trans, log_prev_trans, log_stay_trans = \
+        arrays
+    reads, width = V_prev.shape
+    if rows is None:
+        rows = np.arange(width)
+        V_rows = V_prev
+        log_posterior_rows = log_posterior[:, 1:]
+    else:
+        prev_states = prev_states[rows]
+        prev_trans = prev_trans[rows]
+        stay_trans = stay_trans[rows]
+        log_prev_trans = log_prev_trans[rows]
+        log_stay_trans = log_stay_trans[rows]
+        V_rows = V_prev[:, rows]
+        log_posterior_rows = log_posterior[:, rows + 1]
+    entries = np.arange(len(rows))
+    # index 0 of padded_V is -inf so that padding in prev_states is never
+    # chosen, and the state numbers in prev_states can index it directly
+    padded_V = np.empty((reads, width + 1))
+    padded_V[:, 0] = -np.inf
+    padded_V[:, 1:] = V_prev
+    candidates = padded_V[:, prev_states] + log_prev_trans
+    best = candidates.argmax(axis=2)
+    best_prob = np.take_along_axis(
+        candidates, best[:, :, np.newaxis], axis=2)[:, :, 0]
+    step = best_prob + log_posterior_rows
+    stay = V_rows + log_stay_trans + log_posterior[:, 0, np.newaxis]
+    # a step or skip only replaces the stay if it is strictly
+    # more likely, as in viterbi
+    take_step = step > stay
+    V = np.where(take_step, step, stay)
+    can_stay = stay > -np.inf
+    B = np.where(
+        take_step, prev_states[entries, best],
+        np.where(can_stay, rows + 1, EMPTY_STATE))
+    T = np.where(
+        take_step, prev_trans[entries, best],
+        np.where(can_stay, stay_trans, EMPTY_TRANSITION))
+    return V, B, T
+
+
+def _sum_arrays(arrays):
+    """
+    the predecessor states from _step_arrays with the probabilities, rather
+    than log probabilities, of their transitions and of the stays, as used
+    by _forward_step and _backward_step.
+    """
+    prev_states, prev_trans, stay_trans, log_prev_trans, log_stay_trans = \
+        arrays
+    return prev_states, np.exp(log_prev_trans), np.exp(log_stay_trans)
+
+
+def _forward_step(alpha_prev, posterior, sum_arrays):
+    """
+    advances the scaled forward recursion of a batch of reads by one event,
+    as _viterbi_step but adding up the probabilities of every step, skip
+    and stay in to each state rather than taking the largest.
+    :param alpha_prev: scaled forward probabilities of the previous event,
+    (reads, states-1)
+    :param posterior: posteriors of this event, (reads, states)
+    :param sum_arrays: arrays from _sum_arrays
+    returns the forward probabilities of this event, on the scale of
+    alpha_prev
+    """
+    prev_states, prev_probs, stay_probs = sum_arrays
+    reads, width = alpha_prev.shape
+    # index 0 of padded_alpha is 0 so that padding adds nothing
+    padded_alpha = np.zeros((reads, width + 1))
+    padded_alpha[:, 1:] = alpha_prev
+    # np.take gathers faster than fancy indexing here
+    step = np.take(padded_alpha, prev_states, axis=1)
+    step *= prev_probs
+    step = step.sum(axis=2)
+    step *= posterior[:, 1:]
+    stay = alpha_prev * stay_probs * posterior[:, 0, np.newaxis]
+    return step + stay
+
+
+def _backward_step(beta_next, posterior_next, stay_probs, successors):
+    """
+    takes the scaled backward recursion of a batch of reads back by one
+    event.
+    :param beta_next: scaled backward probabilities of the next event,
+    (reads, states-1)
+    :param posterior_next: posteriors of the next event, (reads, states)
+    :param stay_probs: probability of each kmer staying, from _sum_arrays
+    :param successors: next_states from successor_arrays and the
+    probabilities of their transitions
+    returns the backward probabilities of this event, on the scale of
+    beta_next
+    """
+    next_states, next_probs = successors
+    reads, width = beta_next.shape
+    padded_beta = np.zeros((reads, width + 1))
+    padded_beta[:, 1:] = beta_next * posterior_next[:, 1:]
+    step = np.take(padded_beta, next_states, axis=1)
+    step *= next_probs
+    step = step.sum(axis=2)
+    stay = beta_next * stay_probs * posterior_next[:, 0, np.newaxis]
+    return step + stay
+
+
+def _rescale(column):
+    """
+    divides each read's column of probabilities by its largest value.
+    returns the scaled column and the log of the value divided by, which is
+    0 for reads where every state is impossible.
+    """
+    largest = column.max(axis=1)
+    largest[largest == 0] = 1
+    return column / largest[:, np.newaxis], np.log(largest)
+
+
+def successor_arrays(transition_func, k=5, states=4**5 + 1):
+    """
+    the states each state can step or skip in to, the reverse of
+    predecessor_arrays.
+    :param transition_func: function which determines transition between
+    kmers
+    :param k: k for kmer
+    :param states: number of states including the stay state
+    :type transition_func: python function
+    :type k: int
+    :type states: int
+    returns next_states, next_trans, where next_states[st-1] holds the
+    states st can step or skip in to, padded with 0, and next_trans the
+    matching transition integers, padded with -1.
+    """
+    return transition_structure(
+        transition_func, k=k, states=states).successor_arrays
+
+
+def viterbi_beam(posterior, transition_func, transition_dict=transition_dict,
+                 k=5, beam_width=None, beam_threshold=None):
+    """
+    approximate version of viterbi_numpy which only keeps the most likely
+    states at each event. Only the states which the kept states can stay,
+    step or skip in to are scored at the next event.
+    :param posterior: posterior probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param beam_width: number of states to keep at each event
+    :param beam_threshold: only keep states whose log probability is within
+    this of the most likely state
+    :type posterior: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type beam_width: int
+    :type beam_threshold: float
+    returns compact dynamic programming, backtrace and transitions tables,
+    as viterbi_numpy. States which were not kept have empty slots.
+    Raises ImpossibleTransitionError if every state of an event is impossible.
+    """
+    posterior = _as_posteriors(posterior)[np.newaxis]
+    states, events = posterior.shape[1:]
+    arrays = _step_arrays(transition_func, transition_dict, k, states)
+    next_states = successor_arrays(transition_func, k=k, states=states)[0]
+    B = np.full(
+        (events - 1, states - 1), EMPTY_STATE, dtype=state_dtype(states))
+    T = np.full((events - 1, states - 1), EMPTY_TRANSITION, dtype=np.int8)
+    V = np.full((2, states - 1), -np.inf)
+    V[1] = _prune(
+        _log_column(posterior, 0)[0, 1:], beam_width, beam_threshold)
+    for t in range(1, events):
+        V[0] = V[1]
+        kept = np.flatnonzero(np.isfinite(V[0]))
+        # the kept states can stay, or step or skip in to their successors.
+        # index 0 of scored is the padding in next_states
+        scored = np.zeros(states, dtype=bool)
+        scored[kept + 1] = True
+        scored[next_states[kept]] = True
+        rows = np.flatnonzero(scored[1:])
+        if len(rows) == states - 1:
+            # the beam reaches every state
+            rows = None
+        V_rows, B_rows, T_rows = _viterbi_step(
+            V[0][np.newaxis], _log_column(posterior, t), arrays, rows=rows)
+        if rows is None:
+            rows = np.arange(states - 1)
+        V[1] = -np.inf
+        V[1, rows] = V_rows[0]
+        V[1] = _prune(V[1], beam_width, beam_threshold)
+        if np.isneginf(V[1]).all():
+            raise ImpossibleTransitionError(t)
+        kept_rows = np.isfinite(V[1, rows])
+        B[t-1, rows[kept_rows]] = B_rows[0][kept_rows]
+        T[t-1, rows[kept_rows]] = T_rows[0][kept_rows]
+    return V.T, B.T, T.T
+
+
+def _prune(column, beam_width, beam_threshold):
+    """
+    sets every state outside the beam to -inf.
+    """
+    if beam_threshold is not None:
+        column = np.where(
+            column >= column.max() - beam_threshold, column, -np.inf)
+    if beam_width is not None and beam_width < len(column):
+        outside = np.argpartition(column, -beam_width)[:-beam_width]
+        column = column.copy()
+        column[outside] = -np.inf
+    return column
+
+
+def viterbi_sparse_posterior(posterior, transition_func,
+                             transition_dict=transition_dict, k=5,
+                             beam_width=None,
+                             beam_threshold=SPARSE_BEAM_THRESHOLD):
+    """
+    viterbi_numpy for posteriors which only keep some states of each event,
+    such as those from posterior_formats.sparsify. States which were not
+    kept have a probability of zero, so at each event only the kept kmers,
+    and the states alive at the event before, which can stay, are scored.
+    As the stay state is kept at every event, states alive at one event
+    would be carried on to every later one, so only those in the beam, as
+    in viterbi_beam, are kept alive. The work for an event then grows with
+    the number of states kept and the beam rather than with the square of
+    the number of states. With no beam the result is the same as
+    viterbi_numpy on the sparse posteriors.
+    :param posterior: posteriors of one read, with a column method giving
+    the states kept for an event and their log probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param beam_width: number of states to keep alive at each event
+    :param beam_threshold: only keep states alive whose log probability is
+    within this of the most likely state, None for no threshold
+    :type posterior: posterior_formats.SparsePosteriors
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type beam_width: int
+    :type beam_threshold: float
+    returns compact dynamic programming, backtrace and transitions tables,
+    as viterbi_numpy. States which were not kept alive have empty slots.
+    Raises ImpossibleTransitionError if every state of an event is
+    impossible.
+    """
+    states, events = posterior.shape
+    arrays = _step_arrays(transition_func, transition_dict, k, states)
+    B = np.full(
+        (events - 1, states - 1), EMPTY_STATE, dtype=state_dtype(states))
+    T = np.full((events - 1, states - 1), EMPTY_TRANSITION, dtype=np.int8)
+    V = np.full((2, states - 1), -np.inf)
+    V[1] = _prune(posterior.log_column(0)[1:], beam_width, beam_threshold)
+    alive = np.flatnonzero(np.isfinite(V[1]))
+    log_posterior = np.full((1, states), -np.inf)
+    for t in range(1, events):
+        V[0] = V[1]
+        kept, log_probs = posterior.column(t)
+        log_posterior[0, kept] = log_probs
+        # a kept kmer can be stepped or skipped in to, and the states
+        # alive at the last event can stay if the stay state was kept
+        scored = kept[kept > 0].astype(np.int64) - 1
+        if len(kept) and kept[0] == 0:
+            scored = np.union1d(scored, alive)
+        V_rows, B_rows, T_rows = _viterbi_step(
+            V[0][np.newaxis], log_posterior, arrays, rows=scored)
+        log_posterior[0, kept] = -np.inf
+        V[1, alive] = -np.inf
+        V_rows = V_rows[0]
+        if np.isneginf(V_rows).all():
+            raise ImpossibleTransitionError(t)
+        V_rows = _prune(V_rows, beam_width, beam_threshold)
+        V[1, scored] = V_rows
+        kept_rows = np.isfinite(V_rows)
+        alive = scored[kept_rows]
+        B[t-1, alive] = B_rows[0][kept_rows]
+        T[t-1, alive] = T_rows[0][kept_rows]
+    return V.T, B.T, T.T
+
+
+def beam_report(posteriors, transition_func, transition_dict=transition_dict,
+                k=5, beam_widths=(16, 64, 256), beam_thresholds=()):
+    """
+    compares beam decoding with exact decoding on a batch of reads, so the
+    loss of accuracy can be weighed against the time saved.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events)
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param beam_widths: beam widths to try
+    :param beam_thresholds: log probability thresholds to try
+    :type posteriors: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type beam_widths: tuple
+    :type beam_thresholds: tuple
+    returns a list with a dictionary for each setting, holding the time
+    taken and the fractions from compare_paths, along with a dictionary for
+    exact decoding.
+    """
+    posteriors = _as_posteriors(posteriors)
+    start_time = time.time()
+    exact = [
+        determine_path(*viterbi_numpy(
+            posterior, transition_func, transition_dict=transition_dict,
+            k=k))
+        for posterior in posteriors]
+    report = [{"setting": "exact", "seconds": time.time() - start_time,
+               **compare_paths(exact, exact, k=k)}]
+    settings = [("beam_width", width) for width in beam_widths]
+    settings += [("beam_threshold", threshold)
+                 for threshold in beam_thresholds]
+    for name, value in settings:
+        start_time = time.time()
+        results = [
+            determine_path(*viterbi_beam(
+                posterior, transition_func, transition_dict=transition_dict,
+                k=k, **{name: value}))
+            for posterior in posteriors]
+        report.append({
+            "setting": "{}={}".format(name, value),
+            "seconds": time.time() - start_time,
+            **compare_paths(results, exact, k=k)})
+    return report
+
+
+def compare_paths(results, exact, k=5):
+    """
+    counts how often approximate or compact decoding of a batch of reads
+    differs from exact decoding, for the accuracy reports.
+    :param results: (path, transitions) of each read, or None for a read
+    which could not be decoded
+    :param exact: (path, transitions) of each read from exact decoding, or
+    None
+    :param k: k for kmer
+    :type results: list
+    :type exact: list
+    :type k: int
+    returns a dictionary holding the fraction of reads whose path differs,
+    the fraction whose stitched sequence differs and the fraction of path
+    positions which differ. A read only one of the two could decode counts
+    as differing in path and sequence.
+    """
+    reads_differing = 0
+    sequences_differing = 0
+    positions_differing = 0
+    positions = 0
+    for result, exact_result in zip(results, exact):
+        if result is None or exact_result is None:
+            differs = int(result is not exact_result)
+            reads_differing += differs
+            sequences_differing += differs
+            continue
+        differing = np.count_nonzero(
+            np.array(result[0]) != np.array(exact_result[0]))
+        positions += len(exact_result[0])
+        positions_differing += int(differing)
+        reads_differing += int(differing > 0)
+        sequences_differing += int(
+            stitch_kmers(*result, k=k) != stitch_kmers(*exact_result, k=k))
+    reads = max(len(exact), 1)
+    return {"reads_differing": reads_differing / reads,
+            "sequences_differing": sequences_differing / reads,
+            "positions_differing": positions_differing / max(positions, 1)}
+
+
+def decode_batch(posteriors, transition_func, transition_dict=transition_dict,
+                 k=5, qualities=False):
+    """
+    finds the most likely path of kmers for every read in a batch.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events)
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :type posteriors: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :param qualities: whether to find the quality of each event of the
+    paths as well, see path_qualities
+    :type qualities: bool
+    returns a list with a (path, transitions) pair for each read,
+    as returned by determine_path, or (path, transitions, qualities) with
+    qualities. Reads with an impossible transition in their posteriors are
+    reported and given None instead, without affecting the rest of the
+    batch.
+    """
+    posteriors = _as_posteriors(posteriors)
+    reads, states, events = posteriors.shape
+    with instrumentation.stage("dp", reads=reads, events=reads * events):
+        tables = viterbi_batch(
+            posteriors, transition_func, transition_dict=transition_dict,
+            k=k, forward=qualities)
+    V, B, T = tables[:3]
+    with instrumentation.stage(
+            "traceback", reads=reads, events=reads * events):
+        paths, transitions = determine_paths(V, B, T)
+    if qualities:
+        with instrumentation.stage(
+                "qualities", reads=reads, events=reads * events):
+            event_qualities = path_qualities(
+                posteriors, paths, *tables[3:],
+                transition_func=transition_func,
+                transition_dict=transition_dict, k=k)
+    results = []
+    for n in range(len(V)):
+        try:
+            _check_batch_read(V[n], B[n])
+        except ImpossibleTransitionError as error:
+            print("read", n, ":", error)
+            results.append(None)
+            continue
+        result = (paths[n].tolist(), transitions[n].tolist())
+        if qualities:
+            result += (event_qualities[n].tolist(),)
+        results.append(result)
+    return results
+
+
+def _check_batch_read(V, B):
+    """
+    raises ImpossibleTransitionError if a read decoded by viterbi_batch
+    has an event where every state is impossible.
+    Once every state is impossible every later event is too, so only the
+    last column of V needs checking to find out if there is one. The event
+    is then the first where the backtrace table is empty for every state.
+    """
+    if np.isneginf(V[:, -1]).all():
+        impossible = (B == EMPTY_STATE).all(axis=0)
+        raise ImpossibleTransitionError(int(impossible.argmax()) + 1)
+
+
+def path_qualities(posteriors, paths, F, scales, transition_func,
+                   transition_dict=transition_dict, k=5):
+    """
+    Phred quality of each event of the paths of a batch of reads, from the
+    probability of the read being in the path's kmer at that event given
+    the whole read. This is found by running the backward recursion over
+    the read once, combining it with the forward table from viterbi_batch
+    at the path's kmer of each event.
+    :param posteriors: posterior probabilities in the form
+    (reads, states, events)
+    :param paths: paths of kmers in the form (reads, events), as returned
+    by determine_paths
+    :param F: forward table from viterbi_batch with forward
+    :param scales: scales from viterbi_batch with forward
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :type posteriors: numpy array / torch tensor
+    :type paths: numpy array
+    :type F: numpy array
+    :type scales: numpy array
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    returns qualities as an int64 array of (reads, events), capped at
+    MAX_QUALITY. Reads with an impossible transition get 0.
+    """
+    posteriors = _as_posteriors(posteriors)
+    reads, states, events = posteriors.shape
+    stay_probs = _sum_arrays(
+        _step_arrays(transition_func, transition_dict, k, states))[2]
+    next_states, next_trans = successor_arrays(
+        transition_func, k=k, states=states)
+    successors = next_states, np.exp(
+        _log_transitions(next_trans, transition_dict))
+    read_index = np.arange(reads)
+    # empty slots of a path index the last row, their qualities are not used
+    rows = np.asarray(paths) - 1
+    with np.errstate(divide="ignore"):
+        log_evidence = np.log(
+            F[:, :, -1].sum(axis=1, dtype=np.float64)) + scales[:, -1]
+    # probability of each event being in the path's kmer, i.e.
+    # forward * backward / evidence
+    marginals = np.empty((events, reads))
+    beta = np.ones((reads, states - 1))
+    beta_scale = np.zeros(reads)
+    for t in range(events - 1, -1, -1):
+        if t < events - 1:
+            beta, scale = _rescale(_backward_step(
+                beta, np.exp(_log_column(posteriors, t + 1)), stay_probs,
+                successors))
+            beta_scale += scale
+        with np.errstate(invalid="ignore", over="ignore"):
+            marginals[t] = (
+                F[read_index, rows[:, t], t] * beta[read_index, rows[:, t]] *
+                np.exp(scales[:, t] + beta_scale - log_evidence))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        qualities = -10 * np.log10(1 - np.minimum(marginals.T, 1))
+    qualities[np.isnan(qualities)] = 0
+    return np.minimum(np.rint(qualities), MAX_QUALITY).astype(np.int64)
+
+
+class Checkpoints:
+    """
+    columns of the dynamic programming table saved every interval events
+    by viterbi_checkpointed, from which determine_path_checkpointed rebuilds
+    the backtrace table one segment at a time.
+    columns[i] is the column for event i * interval.
+    """
+    def __init__(self, posterior, arrays, interval, columns, events):
+        self.posterior = posterior
+        self.arrays = arrays
+        self.interval = interval
+        self.columns = columns
+        self.events = events
+
+
+def checkpoint_interval(events, states=4**5 + 1, memory_budget=None,
+                        predecessors=0):
+    """
+    number of events between saved columns for viterbi_checkpointed.
+    Without a memory budget this is the square root of the number of events,
+    so that the saved columns and one segment of the backtrace table both
+    grow with the square root of the read length. With a budget it is the
+    interval needing the least memory, counting the saved columns, one
+    rebuilt segment of the backtrace and transitions tables and the
+    temporary arrays of each event's update.
+    :param events: number of events in the read
+    :param states: number of states including the stay state
+    :param memory_budget: bytes allowed for the saved columns, one segment
+    and the temporary arrays
+    :param predecessors: width of the predecessor arrays, which sets the
+    size of the temporary arrays
+    :type events: int
+    :type states: int
+    :type memory_budget: int
+    :type predecessors: int
+    returns the interval as an int. Raises ValueError if no interval fits
+    in the memory budget.
+    """
+    if memory_budget is None:
+        return max(1, math.ceil(math.sqrt(events)))
+    # viterbi_checkpointed saves float64 columns, and
+    # determine_path_checkpointed stores segments in these dtypes
+    column_bytes = (states - 1) * np.dtype(np.float64).itemsize
+    bytes_per_event = (states - 1) * (
+        np.dtype(state_dtype(states)).itemsize + np.dtype(np.int8).itemsize)
+    # the log transition probabilities are held as float64 throughout, and
+    # _viterbi_step makes two float64 arrays the size of the predecessor
+    # arrays and about twenty the size of a column
+    step_bytes = (states - 1) * (24 * predecessors + 160)
+    # the path and transitions found, as int64
+    path_bytes = 16 * events
+    intervals = np.arange(1, max(events - 1, 1) + 1)
+    needed = ((((events - 1) // intervals) + 1) * column_bytes +
+              intervals * bytes_per_event + step_bytes + path_bytes)
+    best = int(np.argmin(needed))
+    if needed[best] > memory_budget:
+        raise ValueError(
+            "memory budget of {} bytes is below the {} bytes needed for "
+            "{} events".format(memory_budget, int(needed[best]), events))
+    return int(intervals[best])
+
+
+def viterbi_checkpointed(posterior, transition_func,
+                         transition_dict=transition_dict, k=5,
+                         interval=None, memory_budget=None):
+    """
+    same as viterbi_numpy, but instead of a backtrace table only saves a
+    column of the dynamic programming table every interval events.
+    determine_path_checkpointed then finds the same path as determine_path
+    would from the full tables, with memory growing with the square root
+    of the number of events, or bounded by memory_budget.
+    :param posterior: posterior probabilities
+    :param transition_func: function which determines transition probabilities
+    between kmers
+    :param transition_dict: dictionary matching output of transition function
+    to probabilities
+    :param k: k for kmer
+    :param interval: events between saved columns, see checkpoint_interval
+    :param memory_budget: bytes allowed for the saved columns and
+    rebuilding one segment of the backtrace and transitions tables when
+    choosing the interval, see checkpoint_interval
+    :type posterior: numpy array / torch tensor
+    :type transition_func: python function
+    :type transition_dict: dictionary
+    :type k: int
+    :type interval: int
+    :type memory_budget: int
+    returns compact dynamic programming table and the Checkpoints.
+    Raises ImpossibleTransitionError if every state of an event is
+    impossible, and ValueError if the read does not fit in memory_budget.
+    """
+    posterior = _as_posteriors(posterior)[np.newaxis]
+    states, events = posterior.shape[1:]
+    arrays = _step_arrays(transition_func, transition_dict, k, states)
+    if interval is None:
+        interval = checkpoint_interval(
+            events, states=states, memory_budget=memory_budget,
+            predecessors=arrays[0].shape[1])
+    V = np.full((2, 1, states - 1), -np.inf)
+    V[1] = _log_column(posterior, 0)[:, 1:]
+    columns = [V[1, 0].copy()]
+    for t in range(1, events):
+        V[0] = V[1]
+        V[1] = _viterbi_step(V[0], _log_column(posterior, t), arrays)[0]
+        if np.isneginf(V[1]).all():
+            raise ImpossibleTransitionError(t)
+        if t % interval == 0:
+            columns.append(V[1, 0].copy())
+    checkpoints = Checkpoints(posterior, arrays, interval, columns, events)
+    return V[:, 0].T, checkpoints
+
+
+def determine_path_checkpointed(V, checkpoints):
+    """
+    finds the most likely path from the output of viterbi_checkpointed.
+    Working back from the last segment, each segment of the backtrace and
+    transitions tables is rebuilt from its saved column and traced back,
+    then discarded.
+    :param V: compact dynamic programming table
+    :param checkpoints: Checkpoints from viterbi_checkpointed
+    :type V: numpy array
+    :type checkpoints: Checkpoints
+    returns most likely path of kmers and transitions, as determine_path
+    """
+    events = checkpoints.events
+    interval = checkpoints.interval
+    path = np.zeros(events, dtype=np.int64)
+    transitions = np.zeros(events - 1, dtype=np.int64)
+    # index of the state in the table, i.e. kmer number - 1
+    current = int(np.argmax(V[:, -1]))
+    path[-1] = current + 1
+    for index in range(len(checkpoints.columns) - 1, -1, -1):
+        start = index * interval
+        end = min(start + interval, events - 1)
+        if end <= start:
+            continue
+        # rebuild B and T for events start + 1 to end
+        B = np.empty(
+            (end - start, V.shape[0]), dtype=state_dtype(V.shape[0] + 1))
+        T = np.empty((end - start, V.shape[0]), dtype=np.int8)
+        column = checkpoints.columns[index][np.newaxis]
+        for t in range(start + 1, end + 1):
+            column, B_col, T_col = _viterbi_step(
+                column, _log_column(checkpoints.posterior, t),
+                checkpoints.arrays)
+            B[t - start - 1] = B_col[0]
+            T[t - start - 1] = T_col[0]
+        for t in range(end, start, -1):
+            transitions[t-1] = T[t - start - 1, current]
+            current = int(B[t - start - 1, current]) - 1
+            path[t-1] = current + 1
+        # freed before the next segment is allocated, so only one segment
+        # is held at a time
+        del B, T
+    return path.tolist(), transitions.tolist()
+
+
+class StreamingViterbi:
+    """
+    decodes a read as its posteriors arrive, rather than after the whole
+    read has been seen. Posterior columns are pushed in chunks, and bases
+    are returned as soon as every surviving path agrees on them, i.e. once
+    the paths have merged. The backtrace behind the merge point is freed,
+    so memory stays roughly constant for live signal.
+    The bases returned by push and finish join up to the same sequence as
+    stitch_kmers on the path from viterbi_numpy and determine_path.
+    """
+    def __init__(self, transition_func, transition_dict=transition_dict, k=5):
+        """
+        :param transition_func: function which determines transition
+        probabilities between kmers
+        :param transition_dict: dictionary matching output of transition
+        function to probabilities
+        :param k: k for kmer
+        :type transition_func: python function
+        :type transition_dict: dictionary
+        :type k: int
+        """
+        self.transition_func = transition_func
+        self.transition_dict = transition_dict
+        self.k = k
+        self.arrays = None
+        # latest column of the dynamic programming table
+        self.V = None
+        # backtrace and transitions columns held for events base + 1 onwards
+        self.B = []
+        self.T = []
+        # event of the oldest state still held, and whether its bases
+        # have been returned
+        self.base = 0
+        self.base_emitted = False
+        self.events = 0
+
+    def push(self, chunk):
+        """
+        adds posterior columns to the read.
+        :param chunk: posterior probabilities in the form (states, events),
+        or a single column of states
+        :type chunk: numpy array / torch tensor
+        returns the bases which can now be called, as a string.
+        Raises ImpossibleTransitionError if every state of an event is
+        impossible.
+        """
+        chunk = _as_posteriors(chunk)
+        if chunk.ndim == 1:
+            chunk = chunk[:, np.newaxis]
+        if self.arrays is None:
+            self.arrays = _step_arrays(
+                self.transition_func, self.transition_dict, self.k,
+                chunk.shape[0])
+        chunk = chunk[np.newaxis]
+        for t in range(chunk.shape[2]):
+            log_posterior = _log_column(chunk, t)
+            if self.V is None:
+                self.V = log_posterior[:, 1:]
+            else:
+                self.V, B_col, T_col = _viterbi_step(
+                    self.V, log_posterior, self.arrays)
+                self.B.append(B_col[0])
+                self.T.append(T_col[0])
+            if np.isneginf(self.V).all():
+                raise ImpossibleTransitionError(self.events)
+            self.events += 1
+        return self._emit_converged()
+
+    def finish(self):
+        """
+        ends the read, tracing back from the most likely final state.
+        returns the remaining bases, as a string.
+        """
+        if self.V is None:
+            return ""
+        last_state = int(np.argmax(self.V[0])) + 1
+        return self._commit(len(self.B), last_state)
+
+    def _emit_converged(self):
+        """
+        traces every surviving state back until the paths merge, and commits
+        the path up to the latest merge point.
+        """
+        survivors = np.flatnonzero(np.isfinite(self.V[0])) + 1
+        for column in range(len(self.B) - 1, -1, -1):
+            survivors = np.unique(self.B[column][survivors - 1])
+            if len(survivors) == 1:
+                # every path passes through this state at event
+                # base + column
+                return self._commit(column, int(survivors[0]))
+        return ""
+
+    def _commit(self, column, state):
+        """
+        traces back from state at event base + column to base, returns the
+        bases for those events and frees their backtrace columns.
+        """
+        path = np.empty(column + 1, dtype=np.int64)
+        transitions = np.empty(column, dtype=np.int64)
+        path[column] = state
+        for j in range(column - 1, -1, -1):
+            transitions[j] = self.T[j][state - 1]
+            state = int(self.B[j][state - 1])
+            path[j] = state
+        codes = _added_bases(path[1:], transitions, self.k)
+        if not self.base_emitted:
+            codes = np.concatenate(
+                [numbers_to_codes(path[:1], k=self.k)[0], codes])
+            self.base_emitted = True
+        self.B = self.B[column:]
+        self.T = self.T[column:]
+        self.base += column
+        return codes_to_bases(codes)
+
+
+# number of bases added to the sequence by each transition, indexed by the
+# transition integer + 1 so that empty slots (-1) add none
+_bases_added = np.array([0, 0, 2, 1])
+
+
+def _added_bases(kmers, transitions, k):
+    """
+    the 2 bit codes of the bases added to the sequence by transitioning in
+    to each kmer, i.e. the last base of a step, the last two of a skip and
+    none for a stay.
+    """
+    codes = numbers_to_codes(np.asarray(kmers, dtype=np.int64), k=k)
+    counts = _bases_added[np.asarray(transitions, dtype=np.int64) + 1]
+    return codes[np.arange(k) >= k - counts[:, np.newaxis]]
+
+
 def determine_path(V, B, T):
     """
     given a dynamic programming table, a backtrace table and a
@@ -137,37 +1390,85 @@ def determine_path(V, B, T):
     The backtrace table must be formatted so that the first row of the
     table is not stays but AAA etc. A value of 1 in the backtrace
     table is AAA.
+    The path is traced back from the most likely last state, filling
+    preallocated arrays from the end. Compact tables are traced back by
+    numba_kernels.traceback when numba is installed.
     :param V: dynamic programming table.
     :param B: backtrace table
     :param T: transition table
-    :type V: 2d list
-    :type B: 2d list
-    :type T: 2d list
+    :type V: 2d list / numpy array, compact tables are accepted
+    :type B: 2d list / numpy array
+    :type T: 2d list / numpy array
     returns most likely path of kmers
     """
     events = len(B[0])
-    last_prob = [V[i][-1] for i in range(len(V))]
-    # list of final values of probabilities
-    kmer_max_prob = last_prob.index(max(last_prob))
-    likely_path = [kmer_max_prob + 1]
+    # final values of probabilities, only the last column of V is read
+    last_prob = np.array([V[i][-1] for i in range(len(V))])
+    if (numba_kernels.available and isinstance(B, np.ndarray) and
+            isinstance(T, np.ndarray) and B.dtype.kind == "u"):
+        path, transitions, empty = numba_kernels.traceback(
+            last_prob, B, T, EMPTY_STATE)
+        if empty >= 0:
+            print(
+                "None values in backtrace table due to impossible\
+                transitions in posteriors")
+            sys.exit(1)
+        return path.tolist(), transitions.tolist()
+    path = np.empty(events + 1, dtype=np.int64)
+    transitions = np.empty(events, dtype=np.int64)
     # index of the maximum probability i.e. if
     # kmer_max_prob = 1 > AAA was last base in path
-    # this is G. ie. 2.
-    transition = [T[kmer_max_prob][events-1]]
-    row_of_interest = B[kmer_max_prob]
-    for t in range(1, events + 1):
-        previous_kmer = row_of_interest[-1*t]
-        likely_path.insert(0, previous_kmer)
-        if t < events:
-            transition.insert(0, T[previous_kmer-1][(-1*t) - 1])
-        try:
-            row_of_interest = B[previous_kmer-1]
-        except TypeError:
+    kmer = int(np.argmax(last_prob)) + 1
+    path[events] = kmer
+    for t in range(events - 1, -1, -1):
+        previous_kmer = B[kmer - 1][t]
+        # empty slots are None, or EMPTY_STATE in compact backtrace tables
+        if previous_kmer is None or previous_kmer == EMPTY_STATE:
             print(
                 "None values in backtrace table due to impossible\
                 transitions in posteriors")
             sys.exit(1)
-    return likely_path, transition
+        transitions[t] = T[kmer - 1][t]
+        kmer = int(previous_kmer)
+        path[t] = kmer
+    # python integers, as numpy integers would overflow when stitching
+    # kmers together
+    return path.tolist(), transitions.tolist()
+
+
+def determine_paths(V, B, T):
+    """
+    traces back every read of a batch at once, from the tables returned by
+    viterbi_batch.
+    :param V: compact dynamic programming tables, (reads, states-1, 2)
+    :param B: backtrace tables, (reads, states-1, events-1)
+    :param T: transitions tables, (reads, states-1, events-1)
+    :type V: numpy array
+    :type B: numpy array
+    :type T: numpy array
+    returns paths as an int64 array of (reads, events) and transitions as
+    an int64 array of (reads, events-1), as determine_path for each read.
+    Reads which reach an empty slot have EMPTY_STATE and EMPTY_TRANSITION
+    from there back to the start, see _check_batch_read.
+    """
+    reads, width, events = B.shape
+    # events first, which is how viterbi_batch stores the tables
+    B = B.transpose(2, 0, 1)
+    T = T.transpose(2, 0, 1)
+    paths = np.empty((events + 1, reads), dtype=np.int64)
+    transitions = np.empty((events, reads), dtype=np.int64)
+    read_index = np.arange(reads)
+    paths[events] = np.argmax(V[:, :, -1], axis=1) + 1
+    for t in range(events - 1, -1, -1):
+        # empty slots index the last row, and are cleared below
+        rows = paths[t + 1] - 1
+        transitions[t] = T[t][read_index, rows]
+        paths[t] = B[t][read_index, rows]
+    # once a read reaches an empty slot the rest of its path is empty
+    empty = np.logical_or.accumulate(paths[::-1] == EMPTY_STATE)[::-1]
+    paths[empty] = EMPTY_STATE
+    transitions[empty[:-1]] = EMPTY_TRANSITION
+    return paths.T, transitions.T
 
 
 def transition(first, second, k=5):
@@ -204,28 +1505,41 @@ def transition(first, second, k=5):
 def stitch_kmers(kmers, transitions, k=5):
     """
     This function returns a single string of a dna sequence from a series
-    of kmers.
-    """
-    sequence = kmers[0]-1
-    # seq_len in bases
-    seq_len = k
-    for i in range(len(kmers)-1):
-        # step
-        if transitions[i] == 2:
-            # mask the last letter of kmer
-            # pretend that kmer does not account for stays
-            last_added = (kmers[i+1] - 1) & 3
-            # move the sequence up two bits
-            sequence = (sequence << 2) + last_added
-            seq_len += 1
-        # skip
-        if transitions[i] == 1:
-            # mask the last two letters of kmer
-            last_added = (kmers[i+1] - 1) & 15
-            sequence = (sequence << 4) + last_added
-            seq_len += 2
-        # stay
-        if transitions[i] == 0:
-            pass
-        string_seq = number_to_kmer_nostay(sequence, k=seq_len)
-    return string_seq
+    of kmers. kmers and transitions may be lists or numpy arrays,
+    as returned by determine_path or from compact tables.
+    The sequence is built in one pass as an array of 2 bit base codes,
+    starting with the first kmer and adding the bases each step or skip
+    brings in.
+    """
+    kmers = np.asarray(kmers, dtype=np.int64)
+    first = numbers_to_codes(kmers[:1], k=k)[0]
+    added = _added_bases(kmers[1:], transitions[:len(kmers) - 1], k)
+    return codes_to_bases(np.concatenate([first, added]))
+
+
+def base_qualities(transitions, qualities, k=5):
+    """
+    the quality of each base of the sequence stitch_kmers builds from a
+    path, given the quality of each event of the path. The bases of the
+    first kmer take the quality of the first event, and the bases a step or
+    skip adds take the quality of the event they are added at.
+    :param transitions: transitions between the kmers of the path
+    :param qualities: quality of each event, from path_qualities
+    :param k: k for kmer
+    :type transitions: list / numpy array
+    :type qualities: list / numpy array
+    :type k: int
+    returns qualities as an int64 array, one per base
+    """
+    qualities = np.asarray(qualities, dtype=np.int64)
+    counts = _bases_added[
+        np.asarray(transitions[:len(qualities) - 1], dtype=np.int64) + 1]
+    return np.concatenate(
+        [np.repeat(qualities[:1], k), np.repeat(qualities[1:], counts)])
+
+
+def quality_string(qualities):
+    """
+    qualities as the Phred+33 characters of a FASTQ quality line.
+    """
+    return (np.asarray(qualities, dtype=np.uint8) + 33).tobytes().decode()